@@ -0,0 +1,197 @@
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import subprocess
+import contextlib
+
+try:
+	import resource
+except ImportError: # Not available on Windows, peak memory is reported as 0 there
+	resource = None
+
+import ue4fo
+import esmgen
+
+# Measures the throughput of ue4fo.py on synthetic .ESM files of a few sizes
+# (see esmgen.py): parseESM in MB/s and records/s, generateCellManifests in
+# actors/s and writeObjectsToFile in MB/s, along with the peak memory of the
+# process. Results can be saved as a baseline and later runs are compared
+# against it to catch regressions.
+
+# esmgen.py options of each size
+SIZES = {
+	'small' : {'bases' : 50, 'blocks' : 2, 'subblocks' : 2, 'cells' : 4, 'refs' : 25, 'exterior' : 4, 'compressed' : 0.1},
+	'medium' : {'bases' : 200, 'blocks' : 4, 'subblocks' : 4, 'cells' : 8, 'refs' : 50, 'exterior' : 16, 'compressed' : 0.1},
+	'large' : {'bases' : 500, 'blocks' : 10, 'subblocks' : 10, 'cells' : 10, 'refs' : 100, 'exterior' : 32, 'compressed' : 0.1},
+}
+
+# Metric name and whether higher values are better
+METRICS = [
+	('parse MB/s', True),
+	('parse records/s', True),
+	('manifests actors/s', True),
+	('dump MB/s', True),
+	('peak MB', False),
+]
+
+OPTIONS = {
+	'sizes' : 'medium,large', # small finishes too quickly for reliable numbers, but is handy for a quick check
+	'repeat' : 3, # Runs per size, the best result of each metric is kept
+	'baseline' : 'benchmark_baseline.json',
+	'tolerance' : 0.25, # Fraction a metric may get worse by before it counts as a regression
+	'save' : False, # Save the results as the new baseline instead of comparing
+}
+
+# Returns the peak memory of this process in MB
+def getPeakMemory():
+	if resource is None:
+		return 0.0
+
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0) # Bytes on macOS, KB elsewhere
+
+# Counts the references generateCellManifests will write as actors
+def countActors():
+	actors = 0
+	for cell, directory in ue4fo.iterCellManifests():
+		for zoneName, zone in cell.get('Children', {}).items():
+			for child in zone:
+				entry = ue4fo.FORMIDS.get(child.get('NAME'))
+				if entry is not None and entry[2] is not None and 'MODL' in entry[1]:
+					actors += 1
+
+	return actors
+
+# Runs every benchmarked stage once on the .ESM at filepath, in the current
+# directory, and returns the metrics. Meant to run in a fresh process each
+# time so the peak memory belongs to this run alone.
+def runStages(filepath, records):
+	size = os.path.getsize(filepath)
+	with contextlib.redirect_stdout(open(os.devnull, 'w')):
+		start = time.perf_counter()
+		ue4fo.parseESM(filepath)
+		parseTime = time.perf_counter() - start
+		ue4fo.buildFormIDIndex()
+
+		actors = countActors()
+		start = time.perf_counter()
+		ue4fo.generateCellManifests()
+		manifestsTime = time.perf_counter() - start
+
+		start = time.perf_counter()
+		ue4fo.writeObjectsToFile()
+		dumpTime = time.perf_counter() - start
+
+	dumped = sum(os.path.getsize(os.path.join('topgroups', name)) for name in os.listdir('topgroups'))
+	return {
+		'parse MB/s' : size / 1048576.0 / parseTime,
+		'parse records/s' : records / parseTime,
+		'manifests actors/s' : actors / manifestsTime,
+		'dump MB/s' : dumped / 1048576.0 / dumpTime,
+		'peak MB' : getPeakMemory(),
+	}
+
+# Generates the .ESM of a size and benchmarks it repeat times, each run in
+# a new process with the given ue4fo.py settings. Returns the best value
+# of every metric.
+def benchmarkSize(name, settings, repeat):
+	directory = tempfile.mkdtemp(prefix='ue4fo-benchmark-')
+	try:
+		filepath = os.path.join(directory, name + '.esm')
+		stats = esmgen.writeESM(filepath, SIZES[name])
+		print('Benchmarking ' + name + ' (' + str(stats['size'] // 1024) + ' KB, ' + str(stats['records']) + ' records, ' + str(stats['cells']) + ' cells)..')
+
+		best = {}
+		for run in range(repeat):
+			runDirectory = os.path.join(directory, 'run' + str(run))
+			os.makedirs(runDirectory)
+			output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '-stages', filepath, str(stats['records']), json.dumps(settings)], cwd=runDirectory)
+			for metric, value in json.loads(output.decode()).items():
+				higherIsBetter = dict(METRICS)[metric]
+				if metric not in best or (value > best[metric]) == higherIsBetter:
+					best[metric] = value
+
+		return best
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+
+# Returns the baseline key of a size benchmarked with the given settings
+def getBaselineKey(name, settings):
+	return ' '.join([name] + ['-' + key + ('' if value is True else ' ' + str(value)) for key, value in sorted(settings.items())])
+
+# Compares results against their baseline. Returns the list of regressions
+# as (key, metric, baseline value, value).
+def compareResults(results, baseline, tolerance):
+	regressions = []
+	for key, metrics in results.items():
+		for metric, higherIsBetter in METRICS:
+			if key not in baseline or metric not in baseline[key] or baseline[key][metric] <= 0:
+				continue
+
+			change = metrics[metric] / baseline[key][metric] - 1.0
+			if (change < -tolerance) if higherIsBetter else (change > tolerance):
+				regressions.append((key, metric, baseline[key][metric], metrics[metric]))
+
+	return regressions
+
+# Prints results, next to their baseline values if there are any
+def printResults(results, baseline):
+	for key, metrics in results.items():
+		print(key + ':')
+		for metric, higherIsBetter in METRICS:
+			line = '   ' + metric.ljust(20) + ('%.1f' % metrics[metric]).rjust(12)
+			if key in baseline and baseline[key].get(metric):
+				line += ('%.1f' % baseline[key][metric]).rjust(12) + ('%+.1f%%' % ((metrics[metric] / baseline[key][metric] - 1.0) * 100)).rjust(10)
+			print(line)
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == '-stages': # Worker process of benchmarkSize
+		ue4fo.SETTINGS.update(json.loads(sys.argv[4]))
+		print(json.dumps(runStages(sys.argv[2], int(sys.argv[3]))))
+		sys.exit(0)
+
+	# Options of this script, anything else naming a ue4fo.py setting is
+	# passed on to it (e.g. -lazy, -columnar or -jobs 4)
+	options = dict(OPTIONS)
+	settings = {}
+	args = iter(sys.argv[1:])
+	for arg in args:
+		name = arg.lstrip('-')
+		if name in OPTIONS:
+			options[name] = True if isinstance(OPTIONS[name], bool) else type(OPTIONS[name])(next(args, OPTIONS[name]))
+		elif name in ue4fo.SETTINGS and isinstance(ue4fo.SETTINGS[name], bool):
+			settings[name] = True
+		elif name in ue4fo.SETTINGS and isinstance(ue4fo.SETTINGS[name], (int, float)):
+			settings[name] = type(ue4fo.SETTINGS[name])(next(args, ue4fo.SETTINGS[name]))
+
+	baseline = {}
+	if os.path.isfile(options['baseline']):
+		f = open(options['baseline'])
+		try:
+			baseline = json.load(f)
+		finally:
+			f.close()
+
+	results = {}
+	for name in options['sizes'].split(','):
+		results[getBaselineKey(name, settings)] = benchmarkSize(name, settings, options['repeat'])
+
+	printResults(results, baseline)
+
+	if options['save']:
+		baseline.update(results)
+		f = open(options['baseline'], 'w')
+		try:
+			json.dump(baseline, f, indent=1, sort_keys=True)
+		finally:
+			f.close()
+		print('Saved baseline to ' + options['baseline'] + '.')
+	else:
+		regressions = compareResults(results, baseline, options['tolerance'])
+		for key, metric, before, after in regressions:
+			print('Regression in ' + key + ': ' + metric + ' went from ' + '%.1f' % before + ' to ' + '%.1f' % after)
+		if regressions:
+			sys.exit(1)
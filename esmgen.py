@@ -0,0 +1,214 @@
+import sys
+import struct
+import math
+import random
+import zlib
+
+import ue4fo
+
+# Generates synthetic GameBryo .ESM files for benchmarking ue4fo.py without
+# shipping real game data. The files are format valid (the same header,
+# group and subrecord layouts ue4fo.py reads) and hold base records of every
+# supported type, interior cell blocks and a worldspace of exterior cells,
+# all populated with references to those base records.
+
+OPTIONS = {
+	'bases' : 100, # Base records per supported type
+	'blocks' : 4, # Interior cell blocks
+	'subblocks' : 4, # Sub-blocks per interior cell block
+	'cells' : 8, # Cells per interior sub-block
+	'refs' : 50, # References per cell
+	'persistent' : 0.1, # Fraction of references that are persistent
+	'exterior' : 4, # Exterior cells per side of the worldspace grid (0 for no worldspace)
+	'compressed' : 0.0, # Fraction of records that are compressed
+	'seed' : 1,
+}
+
+# Record types of the base records, every type ue4fo.py places in cells
+BASE_TYPES = [rtype for rtype in ue4fo.GRUPS if rtype not in ('CELL', 'WRLD')]
+
+# Record types of references to NPCs and creatures, everything else is a REFR
+REFERENCE_TYPES = {'NPC_' : b'ACHR', 'CREA' : b'ACRE'}
+
+# Sizes of the blocks and sub-blocks of exterior cells, in cells
+EXTERIOR_BLOCK = 32
+EXTERIOR_SUBBLOCK = 8
+
+# Writes a subrecord
+def subrecord(name, data):
+	return ue4fo.SUBRECORD_HEADER.pack(name, len(data)) + data
+
+# Writes a null terminated string subrecord
+def stringSubrecord(name, value):
+	return subrecord(name, value.encode() + b'\x00')
+
+# Writes a record, compressing its data if asked to
+def record(name, formid, data, compress=False):
+	flags = 0
+	if compress:
+		data = ue4fo.UINT32.pack(len(data)) + zlib.compress(data)
+		flags |= ue4fo.COMPRESSED_FLAG
+
+	return ue4fo.RECORD_HEADER.pack(name, len(data), flags, formid, 0, 15, 0) + data
+
+# Writes a group around the already written contents. label is packed as
+# given: 4 raw bytes, a FormID or a block number.
+def group(label, groupType, contents):
+	if isinstance(label, int):
+		label = (ue4fo.INT32 if groupType in (2, 3) else ue4fo.UINT32).pack(label)
+
+	return ue4fo.GROUP_HEADER.pack(b'GRUP', 24 + len(contents), label, groupType, 0, 0) + contents
+
+# Keeps track of the FormIDs handed out and the number of records written
+class Generator(object):
+	def __init__(self, options):
+		self.options = options
+		self.random = random.Random(options['seed'])
+		self.nextFormID = 0x800
+		self.bases = []
+		self.baseTypes = {} # Base record FormID: record type
+		self.stats = {'records' : 0, 'compressed' : 0, 'bases' : 0, 'cells' : 0, 'refs' : 0}
+
+	def formID(self):
+		self.nextFormID += 1
+		return self.nextFormID
+
+	def record(self, name, formid, data):
+		compress = self.random.random() < self.options['compressed']
+		self.stats['records'] += 1
+		self.stats['compressed'] += compress
+		return record(name, formid, data, compress)
+
+	# Writes the top group of one base record type
+	def baseGroup(self, rtype):
+		records = []
+		for i in range(self.options['bases']):
+			formid = self.formID()
+			data = stringSubrecord(b'EDID', rtype + str(i))
+			data += stringSubrecord(b'FULL', rtype.title() + ' ' + str(i))
+			if rtype != 'NPC_': # NPCs are put together from their race and equipment instead
+				data += stringSubrecord(b'MODL', 'Synthetic\\' + rtype + '\\' + rtype + str(i % 25) + '.NIF')
+			if rtype == 'CREA':
+				data += subrecord(b'NIFZ', b''.join(('Synthetic\\CREA\\Part' + str(part) + '.NIF').encode() + b'\x00' for part in range(3)))
+			elif rtype == 'LIGH': # Radius and color, followed by falloff, FOV, value and weight
+				color = [self.random.randint(0, 255) for channel in range(3)]
+				data += subrecord(b'DATA', ue4fo.LIGH_DATA.pack(-1, self.random.randint(128, 1024), *color, 0) + struct.pack('<ffLf', 1.0, 90.0, 0, 0.0))
+			elif rtype == 'CONT':
+				for item in range(3):
+					data += subrecord(b'CNTO', ue4fo.CNTO_DATA.pack(self.random.choice(self.bases or [formid]), item + 1))
+				data += subrecord(b'SNAM', ue4fo.UINT32.pack(0)) + subrecord(b'QNAM', ue4fo.UINT32.pack(0))
+
+			records.append(self.record(rtype.encode(), formid, data))
+			self.bases.append(formid)
+			self.baseTypes[formid] = rtype
+			self.stats['bases'] += 1
+
+		return group(rtype.encode(), 0, b''.join(records))
+
+	# Writes a reference to a random base record at the given position,
+	# placed as an NPC (ACHR) or creature (ACRE) if that is what it is
+	def reference(self, x, y, z):
+		base = self.random.choice(self.bases)
+		data = subrecord(b'NAME', ue4fo.UINT32.pack(base))
+		if self.random.random() < 0.25:
+			data += subrecord(b'XSCL', ue4fo.FLOAT.pack(self.random.uniform(0.5, 2.0)))
+		data += subrecord(b'DATA', ue4fo.REFR_DATA.pack(x, y, z, *[self.random.uniform(-math.pi, math.pi) for i in range(3)]))
+
+		self.stats['refs'] += 1
+		return self.record(REFERENCE_TYPES.get(self.baseTypes[base], b'REFR'), self.formID(), data)
+
+	# Writes a cell and its children group, with references around origin
+	def cell(self, data, origin=(0.0, 0.0)):
+		formid = self.formID()
+		zones = {8 : [], 9 : []}
+		for i in range(self.options['refs']):
+			zone = 8 if self.random.random() < self.options['persistent'] else 9
+			zones[zone].append(self.reference(origin[0] + self.random.uniform(0, ue4fo.CELL_SIZE), origin[1] + self.random.uniform(0, ue4fo.CELL_SIZE), self.random.uniform(-500, 500)))
+
+		children = b''.join(group(formid, zone, b''.join(refs)) for zone, refs in zones.items() if refs)
+		self.stats['cells'] += 1
+		return self.record(b'CELL', formid, data) + group(formid, 6, children)
+
+	# Writes the CELL top group of interior cells
+	def interiorGroup(self):
+		blocks = []
+		for blockNum in range(self.options['blocks']):
+			subblocks = []
+			for subNum in range(self.options['subblocks']):
+				cells = []
+				for cellNum in range(self.options['cells']):
+					edid = 'Interior' + str(blockNum) + '_' + str(subNum) + '_' + str(cellNum)
+					cells.append(self.cell(stringSubrecord(b'EDID', edid) + subrecord(b'DATA', b'\x01')))
+				subblocks.append(group(subNum, 3, b''.join(cells)))
+			blocks.append(group(blockNum, 2, b''.join(subblocks)))
+
+		return group(b'CELL', 0, b''.join(blocks))
+
+	# Writes the WRLD top group holding one worldspace of exterior cells,
+	# centered on the origin
+	def worldGroup(self):
+		worldId = self.formID()
+		side = self.options['exterior']
+		blocks = {}
+		for x in range(-(side // 2), side - side // 2):
+			for y in range(-(side // 2), side - side // 2):
+				data = subrecord(b'DATA', b'\x02') + subrecord(b'XCLC', ue4fo.GRID_DATA.pack(x, y) + b'\x00\x00\x00\x00')
+				cell = self.cell(data, (x * ue4fo.CELL_SIZE, y * ue4fo.CELL_SIZE))
+
+				blockKey = (x // EXTERIOR_BLOCK, y // EXTERIOR_BLOCK)
+				subKey = (x // EXTERIOR_SUBBLOCK, y // EXTERIOR_SUBBLOCK)
+				blocks.setdefault(blockKey, {}).setdefault(subKey, []).append(cell)
+
+		# The persistent cell comes first and holds references from all over the worldspace
+		persistentId = self.formID()
+		span = side * ue4fo.CELL_SIZE / 2
+		refs = [self.reference(self.random.uniform(-span, span), self.random.uniform(-span, span), 0.0) for i in range(self.options['refs'])]
+		children = self.record(b'CELL', persistentId, subrecord(b'DATA', b'\x02'))
+		children += group(persistentId, 6, group(persistentId, 8, b''.join(refs)))
+
+		for (blockX, blockY), subblocks in sorted(blocks.items()):
+			contents = b''.join(group(ue4fo.GRID_LABEL.pack(subY, subX), 5, b''.join(cells)) for (subX, subY), cells in sorted(subblocks.items()))
+			children += group(ue4fo.GRID_LABEL.pack(blockY, blockX), 4, contents)
+
+		world = self.record(b'WRLD', worldId, stringSubrecord(b'EDID', 'SyntheticWorld') + stringSubrecord(b'FULL', 'Synthetic World'))
+		return group(b'WRLD', 0, world + group(worldId, 1, children))
+
+	# Returns the contents of the whole .ESM
+	def generate(self):
+		contents = [group(b'GMST', 0, b'')] # An unsupported top group, skipped by ue4fo.py
+		contents += [self.baseGroup(rtype) for rtype in BASE_TYPES]
+		contents.append(self.interiorGroup())
+		if self.options['exterior'] > 0:
+			contents.append(self.worldGroup())
+
+		header = subrecord(b'HEDR', struct.pack('<fLL', 1.34, self.stats['records'], self.nextFormID + 1))
+		header += stringSubrecord(b'CNAM', 'esmgen')
+		return record(b'TES4', 0, header) + b''.join(contents)
+
+# Writes a synthetic .ESM to filepath. Returns the number of records, base
+# records, cells and references written and the size of the file.
+def writeESM(filepath, options=None):
+	generator = Generator(dict(OPTIONS, **(options or {})))
+	data = generator.generate()
+
+	f = open(filepath, 'wb')
+	try:
+		f.write(data)
+	finally:
+		f.close()
+
+	return dict(generator.stats, size=len(data))
+
+if __name__ == '__main__':
+	options = {}
+	args = iter(sys.argv[2:])
+	for arg in args:
+		name = arg.lstrip('-')
+		if name in OPTIONS:
+			options[name] = type(OPTIONS[name])(next(args, OPTIONS[name]))
+
+	if len(sys.argv) > 1 and not sys.argv[1].startswith('-'):
+		stats = writeESM(sys.argv[1], options)
+		print('Wrote ' + sys.argv[1] + ': ' + ', '.join(str(value) + ' ' + name for name, value in stats.items()))
+	else:
+		print('Please specify the path of the .ESM file to write, followed by any of: ' + ' '.join('-' + name + ' N' for name in OPTIONS))
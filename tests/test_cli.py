@@ -0,0 +1,99 @@
+import os
+import sys
+import shutil
+import sqlite3
+import tempfile
+import subprocess
+import unittest
+import unittest.mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import esmgen
+import ue4fo
+
+# Small synthetic .ESM options, enough for a few interior and exterior cells
+ESM_OPTIONS = {'bases' : 5, 'blocks' : 1, 'subblocks' : 1, 'cells' : 2, 'refs' : 5, 'exterior' : 2, 'compressed' : 0.2}
+
+# Runs ue4fo.py with the given arguments in its own process (the command
+# line works on the module globals) from directory, returning its output
+def runUE4FO(directory, *args):
+	return subprocess.check_output([sys.executable, os.path.join(ROOT, 'ue4fo.py')] + list(args), cwd=directory).decode()
+
+# Returns the paths of every .T3D file written under directory
+def listT3DFiles(directory):
+	return sorted(os.path.relpath(os.path.join(path, name), directory) for path, dirs, names in os.walk(directory) for name in names if name.endswith('.t3d'))
+
+# -cell combined with the flags that pick what gets written
+class CellFlagsTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp(prefix='ue4fo-test-')
+		self.esm = os.path.join(self.directory, 'test.esm')
+		esmgen.writeESM(self.esm, ESM_OPTIONS)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory, ignore_errors=True)
+
+	def testCellWritesOnlyMatchingCell(self):
+		runUE4FO(self.directory, self.esm, '-cell', 'Interior0_0_0')
+		self.assertEqual(listT3DFiles(self.directory), [os.path.join('cells', '0', '0', 'Interior0_0_0.t3d')])
+
+	def testCellWithNoManifestsWritesNothing(self):
+		runUE4FO(self.directory, self.esm, '-cell', 'Interior0_0_0', '-nomanifests')
+		self.assertEqual(listT3DFiles(self.directory), [])
+
+	def testCellWithDumpsWritesEverythingParsed(self):
+		runUE4FO(self.directory, self.esm, '-cell', 'Interior0_0_0', '-nomanifests', '-sqlite', 'x.sqlite', '-dumpgroups')
+		self.assertEqual(listT3DFiles(self.directory), [])
+		self.assertTrue(os.path.isfile(os.path.join(self.directory, 'topgroups', 'STAT.txt')))
+
+		db = sqlite3.connect(os.path.join(self.directory, 'x.sqlite'))
+		try:
+			self.assertEqual(db.execute("SELECT COUNT(*) FROM cells WHERE edid = 'Interior0_0_1'").fetchone()[0], 1)
+			self.assertGreater(db.execute('SELECT COUNT(*) FROM records').fetchone()[0], 0)
+		finally:
+			db.close()
+
+	def testCellWithDumpsStillWritesOnlyMatchingCell(self):
+		runUE4FO(self.directory, self.esm, '-cell', 'Interior0_0_0', '-dumpgroups')
+		self.assertEqual(listT3DFiles(self.directory), [os.path.join('cells', '0', '0', 'Interior0_0_0.t3d')])
+		self.assertTrue(os.path.isfile(os.path.join(self.directory, 'topgroups', 'STAT.txt')))
+
+# Stands in for the batch process pool, recording how many workers it was asked for
+class PoolStarted(Exception):
+	pass
+
+def startPool(max_workers=None, mp_context=None):
+	raise PoolStarted(max_workers)
+
+# Size of the -batch process pool
+class BatchJobsTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp(prefix='ue4fo-test-')
+		self.esm = os.path.join(self.directory, 'test.esm')
+		esmgen.writeESM(self.esm, ESM_OPTIONS)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory, ignore_errors=True)
+
+	def getWorkers(self, jobs):
+		with unittest.mock.patch.dict(ue4fo.SETTINGS, jobs=jobs), unittest.mock.patch('concurrent.futures.ProcessPoolExecutor', startPool):
+			with self.assertRaises(PoolStarted) as started:
+				ue4fo.runBatch([self.esm], os.path.join(self.directory, 'out'))
+		return started.exception.args[0]
+
+	def testJobsNotGivenUsesEveryCPU(self):
+		self.assertIsNone(self.getWorkers(None))
+
+	def testJobsZeroUsesEveryCPU(self):
+		self.assertIsNone(self.getWorkers(0))
+
+	def testJobsOneUsesOneProcess(self):
+		self.assertEqual(self.getWorkers(1), 1)
+
+	def testJobsGivenUsesThatManyProcesses(self):
+		self.assertEqual(self.getWorkers(3), 3)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import esmgen
+import ue4fo
+
+# Small synthetic .ESM options, enough for a few interior and exterior cells
+ESM_OPTIONS = {'bases' : 5, 'blocks' : 1, 'subblocks' : 1, 'cells' : 2, 'refs' : 5, 'exterior' : 2, 'compressed' : 0.2}
+
+# Returns the placement of every reference of file, read outside activate()
+def getPlacements(file):
+	return [(child.get('DATA'), child.get('XSCL')) for cell, zoneName, child in file.references()]
+
+# ESMFiles loaded with different settings side by side
+class ESMFileSettingsTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp(prefix='ue4fo-test-')
+		self.esm = os.path.join(self.directory, 'test.esm')
+		esmgen.writeESM(self.esm, ESM_OPTIONS)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory, ignore_errors=True)
+
+	def assertScaled(self, placements, reference, factor):
+		self.assertEqual(len(placements), len(reference))
+		for (data, xscl), (referenceData, referenceXSCL) in zip(placements, reference):
+			self.assertAlmostEqual(xscl, referenceXSCL * factor, places=3)
+			for value, referenceValue in zip(data[:3], referenceData[:3]):
+				self.assertAlmostEqual(value, referenceValue * factor, places=1)
+
+	def testReferencesUseTheFilesScale(self):
+		default = ue4fo.ESMFile(self.esm)
+		for columnar in (False, True):
+			scaled = ue4fo.ESMFile(self.esm, columnar=columnar, scale=ue4fo.SETTINGS['scale'] * 2)
+			self.assertScaled(getPlacements(scaled), getPlacements(default), 2)
+
+	def testReferencesMatchInsideAndOutsideActivate(self):
+		scaled = ue4fo.ESMFile(self.esm, columnar=True, scale=2.0)
+		unscaled = ue4fo.ESMFile(self.esm, columnar=True, scale=1.0)
+
+		# The first read transforms the columns, so make it under the other file's settings
+		with unscaled.activate():
+			inside = getPlacements(scaled)
+		self.assertEqual(getPlacements(scaled), inside)
+		self.assertScaled(inside, getPlacements(unscaled), 2)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -2,14 +2,113 @@ import sys
 import struct
 import os
 import math
+import mmap
+import contextlib
+import collections
+import collections.abc
+import hashlib
+import pickle
+import concurrent.futures
+import multiprocessing
+import zlib
+import array
+import fnmatch
+import time
+import json
+import sqlite3
+import threading
+import queue
+import copy
+
+try:
+	import numpy
+except ImportError: # Optional, only used to speed up -columnar
+	numpy = None
+
+try:
+	import resource
+except ImportError: # Not available on Windows, only used for the peak memory of -profile
+	resource = None
 
 SETTINGS = {
 	'dumpgroups' : False,
 	'nomanifests' : False,
 	'allsubs' : False,
+	'mmap' : True,
+	'index' : False,
+	'cache' : False,
+	'rebuildcache' : False,
+	'jobs' : None, # None unless -jobs is given, see getJobs
+	'tile' : 1,
+	'lazy' : False,
+	'columnar' : False,
+	'floatformat' : None,
+	'incremental' : False,
+	'stream' : False,
+	'cells' : [],
+	'profile' : None,
+	'cprofile' : None,
+	'tracemalloc' : False,
+	'instance' : 0,
+	'sqlite' : None,
+	'writers' : 0,
+	'recordcache' : 0,
+	'recordcachemb' : 0.0,
+	'batch' : None,
 	'scale' : 1.4
 }
 
+# Precompiled layouts used by the memory-mapped reader. Records and groups
+# both have a 24 byte header (including the 4 byte type name), subrecords
+# have a 6 byte header.
+ENTRY_HEADER = struct.Struct('<4sL') # Type name, size (shared by records and groups)
+RECORD_HEADER = struct.Struct('<4sLLLLHh') # Type, data size, flags, FormID, version control, form version, version control 2
+GROUP_HEADER = struct.Struct('<4sL4slLL') # 'GRUP', group size (including header), label, group type, timestamp, version
+SUBRECORD_HEADER = struct.Struct('<4sH') # Type, data size
+UINT32 = struct.Struct('<L')
+INT32 = struct.Struct('<l')
+FLOAT = struct.Struct('<f')
+CNTO_DATA = struct.Struct('<LL') # Object FormID, count
+COMPRESSED_DATA = struct.Struct('<4sLL') # Type name, data size, flags (peeked without unpacking the whole header)
+REFR_DATA = struct.Struct('<6f') # X/Y/Z position, X/Y/Z rotation in radians
+GRID_DATA = struct.Struct('<ll') # Exterior cell grid X, Y (XCLC)
+GRID_LABEL = struct.Struct('<hh') # Exterior block/sub-block group label, grid Y, X (note the reverse order)
+LIGH_DATA = struct.Struct('<lL3BxL') # Time, radius, color R/G/B, flags (followed by falloff, FOV, value and weight, which vary between games)
+
+# Size of an exterior cell along each axis, in game units
+CELL_SIZE = 4096
+
+# Record flag marking records whose data is a 4 byte decompressed size
+# followed by zlib compressed subrecords
+COMPRESSED_FLAG = 0x00040000
+
+# Records flagged as deleted, used by plugins to remove records of their masters
+DELETED_FLAG = 0x00000020
+
+# Compressed records inflated ahead of time by prefetchCompressed, keyed by
+# (id of the buffer, record offset). Entries are removed once parsed.
+INFLATED = {}
+
+# Layouts of the offset index persisted next to the .ESM (see buildIndex)
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<8sLQQL') # Magic, version, .ESM size, .ESM mtime (ns), entry count
+INDEX_ENTRY = struct.Struct('<4sL4slQLLl') # Type, FormID, label, group type, offset, size, flags, parent entry
+
+# Bump whenever the structure of GRUPS changes so old parse caches are discarded
+CACHE_VERSION = 4
+
+# Fingerprints of the .T3D files written by an incremental export are kept
+# in this file (see generateCellManifestsIncremental). Bump the version
+# whenever the .T3D output changes in a way the fingerprints don't cover.
+EXPORT_MANIFEST_PATH = 'cells/.manifest'
+EXPORT_MANIFEST_VERSION = 2
+FINGERPRINT_REF = struct.Struct('<L7d') # Base FormID, position, rotation, scale
+
+# One entry in the offset index. Groups have a type of 'GRUP' and describe
+# themselves, records carry the label and type of the group containing them.
+# Offsets point at the entry's type name and sizes always include the header.
+IndexEntry = collections.namedtuple('IndexEntry', ['type', 'formid', 'label', 'groupType', 'offset', 'size', 'flags', 'parent'])
+
 # This will be our topmost data structure to hold the
 # parsed contents of each .ESM top group
 GRUPS = {
@@ -26,8 +125,19 @@ GRUPS = {
 	'KEYM' : {},
 	'MISC' : {},
 	'WEAP' : {},
+	'LIGH' : {},
+	'NPC_' : {},
+	'CREA' : {},
+	'WRLD' : {},
 }
 
+# Lookup tables built from GRUPS once parsing is done (see buildFormIDIndex).
+# FORMIDS maps a FormID to a (record type, record, T3D writer) tuple, where
+# the writer is None for records that aren't written to .T3D files. EDIDS
+# maps an Editor ID to its FormID and is filled on the first lookup.
+FORMIDS = {}
+EDIDS = {}
+
 # Parses a generic record. Doesn't work for some like REFR because REFR is semi-special
 # in that it describes a reference to an actual record. Other records are much
 # more similar and thus can be handled by the generic parseRecord.
@@ -42,6 +152,10 @@ def parseRecord(f, rtype):
 	formvs = struct.unpack('<H', f.read(2))[0]
 	vcontrol2 = struct.unpack('<h', f.read(2))[0]
 
+	if flags & COMPRESSED_FLAG:
+		parseRecordBuf(readRecordBuf(f, size), 0, rtype)
+		return
+
 	# Get the first subrecord name and create our result dict
 	subName = f.read(4).decode()
 	result = {}
@@ -51,34 +165,7 @@ def parseRecord(f, rtype):
 		subSize = struct.unpack('<H', f.read(2))[0]
 		subData = f.read(subSize)
 
-		if subName == 'EDID': # Editor ID
-			result['EDID'] = subData.decode('utf-8', 'ignore').replace('\x00', '')
-
-		if subName == 'FULL': # Full name
-			result['FULL'] = subData.decode('utf-8', 'ignore').replace('\x00', '')
-
-		if subName == 'MODL': # Model filename
-			result['MODL'] = subData.decode('utf-8', 'ignore').replace('\x00', '').replace('\\', '/')
-
-		# Parse object-specific subrecords
-		if rtype == 'CONT': # Container
-			result['CNTO'] = {}
-			while subName == 'CNTO': # Object list
-				obFormId = struct.unpack('<L', subData[:4])[0]
-				obCount = struct.unpack('<L', subData[4:9])[0]
-				result['CNTO'][obFormId] = obCount
-
-				# Load the next subrecord, if it's more container objects
-				# the loop will parse it, otherwise the loop will exit and
-				# normal parsing will continue
-				subName = f.read(4).decode()
-				subSize = struct.unpack('<H', f.read(2))[0]
-				subData = f.read(subSize)
-
-			if subName == 'SNAM': # Open sound
-				result['SNAM'] = struct.unpack('<L', subData)[0]
-			if subName == 'QNAM': # Close sound
-				result['QNAM'] = struct.unpack('<L', subData)[0]
+		decodeBaseSubrecord(result, rtype, subName.encode(), subData)
 
 		subName = f.read(4).decode() # Read the next subrecord name
 
@@ -93,6 +180,9 @@ def parseREFR(f):
 	formvs = struct.unpack('<H', f.read(2))[0]
 	vcontrol2 = struct.unpack('<h', f.read(2))[0]
 
+	if flags & COMPRESSED_FLAG:
+		return parseREFRBuf(readRecordBuf(f, size), 0)
+
 	subName = f.read(4).decode()
 	result = {}
 	
@@ -133,6 +223,8 @@ def parseREFR(f):
 # parseRecord method.
 parseFuncs = {}
 parseFuncs['REFR'] = parseREFR
+parseFuncs['ACHR'] = parseREFR # Placed NPC, laid out like a REFR
+parseFuncs['ACRE'] = parseREFR # Placed creature, laid out like a REFR
 
 # Parses a group. This method calls itself numerous times to parse
 # groups stored within groups and handle the different types of groups
@@ -294,13 +386,16 @@ def parseCell(f):
 	formvs = struct.unpack('<H', f.read(2))[0]
 	vcontrol2 = struct.unpack('<h', f.read(2))[0]
 	
-	f.seek(f.tell() + 4) # Skip to the EDID size
-	EDIDSize = struct.unpack('<H', f.read(2))[0]
-	EDIDName = f.read(EDIDSize).decode().replace('\x00', '')
-	
-	f.seek(f.tell() + 4) # Skip to the FULL size
-	fullNameSize = struct.unpack('<H', f.read(2))[0]
-	fullName = f.read(fullNameSize).decode().replace('\x00', '')
+	if flags & COMPRESSED_FLAG:
+		EDIDName = parseCellBuf(readRecordBuf(f, size), 0).get('EDID', '')
+	else:
+		f.seek(f.tell() + 4) # Skip to the EDID size
+		EDIDSize = struct.unpack('<H', f.read(2))[0]
+		EDIDName = f.read(EDIDSize).decode().replace('\x00', '')
+
+		f.seek(f.tell() + 4) # Skip to the FULL size
+		fullNameSize = struct.unpack('<H', f.read(2))[0]
+		fullName = f.read(fullNameSize).decode().replace('\x00', '')
 
 	result['FormID'] = formid
 	result['EDID'] = EDIDName
@@ -315,6 +410,13 @@ def parseCell(f):
 	f.seek(f.tell() - 4) # Seek back to start of the next record if we didn't find a GRUP
 	return result
 
+# Reads a whole record, header included, once its header has been read,
+# leaving f at the start of the next one. Compressed records are handed to
+# the memory-mapped parsers this way, which know how to inflate them.
+def readRecordBuf(f, size):
+	f.seek(f.tell() - 24)
+	return memoryview(f.read(24 + size))
+
 # Skips over a record and seeks to the start of the next one.
 # Assumes the calling method did not seek back to the beginning of
 # record and we are currently at the position of the size data.
@@ -322,8 +424,1477 @@ def skipRecord(f):
 	size = struct.unpack('<L', f.read(4))[0]
 	f.seek(f.tell() + size + 16) # Seek past data + remainder of header
 
+# Walks the records and groups stored directly within [pos, end) of a
+# memory-mapped file, yielding the offset and type name of each one. Sizes
+# from the headers are used to hop over entries, so nested groups are not
+# descended into.
+def iterEntries(buf, pos, end):
+	while pos < end:
+		name, size = ENTRY_HEADER.unpack_from(buf, pos)
+		yield pos, name
+
+		if name == b'GRUP': # Group sizes include the header
+			pos += size
+		else:
+			pos += size + 24
+
+# Walks the subrecords of a record stored within [pos, end), yielding the
+# name and a zero-copy memoryview slice of the data for each one.
+def iterSubrecords(buf, pos, end):
+	while pos < end:
+		subName, subSize = SUBRECORD_HEADER.unpack_from(buf, pos)
+		pos += 6
+
+		if subName == b'XXXX': # The next subrecord is too big for a 16 bit size, the real size is stored here
+			subSize = UINT32.unpack_from(buf, pos)[0]
+			subName = SUBRECORD_HEADER.unpack_from(buf, pos + 4)[0]
+			pos += 10
+
+		yield subName, buf[pos:pos + subSize]
+		pos += subSize
+
+# Inflates the data of the compressed record at pos
+def inflateRecord(buf, pos, size):
+	return zlib.decompress(buf[pos + 28:pos + 24 + size], 15, UINT32.unpack_from(buf, pos + 24)[0])
+
+# Inflates a list of (offset, size) compressed records, for the thread pool
+def inflateRecords(buf, records):
+	return [inflateRecord(buf, pos, size) for pos, size in records]
+
+# Finds every compressed record within [pos, end) (descending into groups)
+# that we are going to parse, and inflates them all up front on a pool of
+# threads. zlib releases the GIL while it works, so decompression runs in
+# parallel instead of one record at a time in the middle of parsing. With
+# skipBlocks, interior and exterior cell blocks are left out, to be
+# inflated one at a time by prefetchBlock as they are parsed.
+def prefetchCompressed(buf, pos, end, skipBlocks=False):
+	INFLATED.clear()
+	wanted = set(parseFuncsBuf) | {b'CELL', b'WRLD'}
+	if not SETTINGS['lazy']: # Lazy records inflate themselves when they are first used
+		wanted |= set(rtype.encode() for rtype in GRUPS)
+
+	records = []
+	while pos < end:
+		name, size, flags = COMPRESSED_DATA.unpack_from(buf, pos)
+		if name == b'GRUP':
+			if skipBlocks and GROUP_HEADER.unpack_from(buf, pos)[3] in (2, 4): # Cell block, skip over it
+				pos += size
+			else: # Step inside the group
+				pos += 24
+			continue
+
+		if flags & COMPRESSED_FLAG and name in wanted:
+			records.append((pos, size))
+		pos += size + 24
+
+	threads = os.cpu_count() or 1
+	if len(records) < 16 or threads == 1: # Not worth starting threads for
+		for pos, size in records:
+			INFLATED[(id(buf), pos)] = inflateRecord(buf, pos, size)
+		return
+
+	chunkSize = max(1, len(records) // (threads * 4))
+	chunks = [records[i:i + chunkSize] for i in range(0, len(records), chunkSize)]
+	with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+		for chunk, inflated in zip(chunks, pool.map(lambda chunk: inflateRecords(buf, chunk), chunks)):
+			for (pos, size), data in zip(chunk, inflated):
+				INFLATED[(id(buf), pos)] = data
+
+# Returns the buffer holding the subrecords of the record at pos, along with
+# their start and end offsets in it, given the data size and flags from its
+# header. Compressed records are inflated first, unless prefetchCompressed
+# has already done so.
+def getRecordData(buf, pos, size, flags):
+	if not flags & COMPRESSED_FLAG:
+		return buf, pos + 24, pos + 24 + size
+
+	data = INFLATED.pop((id(buf), pos), None)
+	if data is None:
+		data = inflateRecord(buf, pos, size)
+	return memoryview(data), 0, len(data)
+
+# Decodes a null terminated string subrecord
+def decodeString(data):
+	return str(data, 'utf-8', 'ignore').replace('\x00', '')
+
+# Memory-mapped counterpart of parseRecord. buf is a memoryview over the whole
+# file and pos is the offset of the record's type name. Record and subrecord
+# sizes tell us exactly where everything ends, so there's no peeking ahead.
+def parseRecordBuf(buf, pos, rtype):
+	name, size, flags, formid, vcontrol, formvs, vcontrol2 = RECORD_HEADER.unpack_from(buf, pos)
+
+	# Worldspaces are excluded as their persistent cell gets attached to them later
+	if SETTINGS['lazy'] and rtype != 'WRLD':
+		GRUPS[rtype][formid] = LazyRecord(rtype, buf[pos + 24:pos + 24 + size], flags & COMPRESSED_FLAG)
+		return
+
+	GRUPS[rtype][formid] = decodeRecordBuf(buf, pos, rtype)
+
+# Decodes the base record of type rtype at pos into a dict
+def decodeRecordBuf(buf, pos, rtype):
+	size, flags = RECORD_HEADER.unpack_from(buf, pos)[1:3]
+	result = {}
+	for subName, subData in iterSubrecords(*getRecordData(buf, pos, size, flags)):
+		decodeBaseSubrecord(result, rtype, subName, subData)
+
+	return result
+
+# Decoders of base record subrecords. Each stores the decoded value of one
+# subrecord in the record dict, under the subrecord's name. Names and model
+# paths are shared by many records, so they are interned to keep a single
+# copy of each (Editor IDs are unique, so there is no point).
+def decodeEDID(result, subData): # Editor ID
+	result['EDID'] = decodeString(subData)
+
+def decodeFULL(result, subData): # Full name
+	result['FULL'] = sys.intern(decodeString(subData))
+
+def decodeMODL(result, subData): # Model filename
+	result['MODL'] = sys.intern(decodeString(subData).replace('\\', '/'))
+
+def decodeCNTO(result, subData): # Container object list
+	obFormId, obCount = CNTO_DATA.unpack_from(subData)
+	result.setdefault('CNTO', {})[obFormId] = obCount
+
+def decodeSNAM(result, subData): # Open sound
+	result['SNAM'] = UINT32.unpack_from(subData)[0]
+
+def decodeQNAM(result, subData): # Close sound
+	result['QNAM'] = UINT32.unpack_from(subData)[0]
+
+def decodeNIFZ(result, subData): # Creature body part models
+	result['NIFZ'] = [sys.intern(model.replace('\\', '/')) for model in str(subData, 'utf-8', 'ignore').split('\x00') if model]
+
+def decodeLIGH_DATA(result, subData): # Light radius and color
+	time, radius, red, green, blue, flags = LIGH_DATA.unpack_from(subData)
+	result['DATA'] = {'Time' : time, 'Radius' : radius, 'Color' : [red, green, blue], 'Flags' : flags}
+
+# Subrecord decoders of every base record type, by subrecord name. The ones
+# in BASE_DECODERS apply to every type, the rest to a single type. Anything
+# not listed is skipped. Adding a type or subrecord only takes an entry here.
+BASE_DECODERS = {b'EDID' : decodeEDID, b'FULL' : decodeFULL, b'MODL' : decodeMODL}
+RECORD_DECODERS = {
+	'CONT' : {b'CNTO' : decodeCNTO, b'SNAM' : decodeSNAM, b'QNAM' : decodeQNAM},
+	'LIGH' : {b'DATA' : decodeLIGH_DATA},
+	'CREA' : {b'NIFZ' : decodeNIFZ},
+}
+SUBRECORD_DECODERS = {rtype : dict(list(BASE_DECODERS.items()) + list(RECORD_DECODERS.get(rtype, {}).items())) for rtype in GRUPS}
+
+# Decodes a single subrecord of a base record into the result dict
+def decodeBaseSubrecord(result, rtype, subName, subData):
+	decoder = SUBRECORD_DECODERS[rtype].get(subName)
+	if decoder is not None:
+		decoder(result, subData)
+	elif PROFILE is not None:
+		noteUnknownSubrecord(rtype.encode(), subName, subData)
+
+# A base record that holds on to its raw subrecord data (a zero-copy slice
+# of the mapped .ESM) and only decodes a subrecord the first time it is
+# looked up. Otherwise behaves like the read-only equivalent of the dict
+# parseRecordBuf builds, so it can be used anywhere those are.
+class LazyRecord(collections.abc.Mapping):
+	__slots__ = ('rtype', 'raw', 'compressed', 'subrecords', 'decoded')
+
+	def __init__(self, rtype, raw, compressed):
+		self.rtype = rtype
+		self.raw = raw
+		self.compressed = compressed
+		self.subrecords = None # Subrecord name -> list of data slices, filled on first access
+		self.decoded = {}
+
+	# Returns the record's subrecords by name, inflating and scanning
+	# the raw data the first time around
+	def getSubrecords(self):
+		if self.subrecords is None:
+			raw = self.raw
+			if self.compressed:
+				raw = memoryview(zlib.decompress(raw[4:], 15, UINT32.unpack_from(raw)[0]))
+
+			decoders = SUBRECORD_DECODERS[self.rtype]
+			subrecords = {}
+			for subName, subData in iterSubrecords(raw, 0, len(raw)):
+				if subName in decoders:
+					subrecords.setdefault(subName.decode(), []).append(subData)
+				elif PROFILE is not None:
+					noteUnknownSubrecord(self.rtype.encode(), subName, subData)
+			self.subrecords = subrecords
+
+		return self.subrecords
+
+	def __getitem__(self, key):
+		if key not in self.decoded:
+			if key not in self.getSubrecords():
+				raise KeyError(key)
+
+			result = {}
+			for subData in self.subrecords[key]:
+				decodeBaseSubrecord(result, self.rtype, key.encode(), subData)
+			self.decoded[key] = result[key]
+
+		return self.decoded[key]
+
+	def __contains__(self, key):
+		return key in self.getSubrecords()
+
+	def __iter__(self):
+		return iter(self.getSubrecords())
+
+	def __len__(self):
+		return len(self.getSubrecords())
+
+	def __repr__(self):
+		return repr(dict(self))
+
+	# Pickled (for the parse cache or worker processes) as a copy of the
+	# raw data, since the mapping it points into can't travel with it
+	def __reduce__(self):
+		return (LazyRecord, (self.rtype, bytes(self.raw), self.compressed))
+
+# Keeps a bounded number of base records decoded (see -recordcache), on
+# behalf of StoredRecords. Records are decoded from the mapped .ESM on first
+# use and the least recently used are dropped once there are more than
+# maxRecords of them or they take up more than maxBytes (either may be 0
+# for no limit), to be decoded again if they are needed later.
+class RecordStore(object):
+	def __init__(self, maxRecords, maxBytes):
+		self.maxRecords = maxRecords
+		self.maxBytes = maxBytes
+		self.records = collections.OrderedDict() # StoredRecord: (decoded record, size)
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	# Returns the decoded record a StoredRecord stands for
+	def load(self, stored):
+		cached = self.records.get(stored)
+		if cached is not None:
+			self.hits += 1
+			self.records.move_to_end(stored)
+			return cached[0]
+
+		self.misses += 1
+		record = decodeRecordBuf(stored.buf, stored.offset, stored.rtype)
+		if stored.plugin is not None:
+			remapRecord(stored.plugin, record)
+
+		size = getRecordSize(record)
+		self.records[stored] = (record, size)
+		self.size += size
+		while len(self.records) > 1 and ((self.maxRecords and len(self.records) > self.maxRecords) or (self.maxBytes and self.size > self.maxBytes)):
+			self.size -= self.records.popitem(last=False)[1][1]
+			self.evictions += 1
+
+		return record
+
+	# Number of StaticMeshActor fragments (see ACTOR_FRAGMENTS) worth keeping
+	# around, in line with the number of records held decoded
+	def getFragmentLimit(self):
+		return self.maxRecords or max(len(self.records), 1)
+
+	def getStats(self):
+		return {'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions, 'resident' : len(self.records), 'residentBytes' : self.size}
+
+# Rough number of bytes a decoded base record takes up
+def getRecordSize(record):
+	size = sys.getsizeof(record)
+	for key, value in record.items():
+		size += sys.getsizeof(value)
+		if isinstance(value, dict): # CNTO, LIGH DATA
+			size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+		elif isinstance(value, list): # NIFZ
+			size += sum(sys.getsizeof(v) for v in value)
+
+	return size
+
+# A base record known only by where it is in the mapped .ESM (and the plugin
+# it comes from, for load orders), standing in for the dict parseRecordBuf
+# would have built. Every lookup goes through its RecordStore, so only the
+# records in use are held decoded.
+class StoredRecord(collections.abc.Mapping):
+	__slots__ = ('store', 'buf', 'offset', 'rtype', 'plugin')
+
+	def __init__(self, store, buf, offset, rtype, plugin=None):
+		self.store = store
+		self.buf = buf
+		self.offset = offset
+		self.rtype = rtype
+		self.plugin = plugin
+
+	def __getitem__(self, key):
+		return self.store.load(self)[key]
+
+	def __contains__(self, key):
+		return key in self.store.load(self)
+
+	def __iter__(self):
+		return iter(self.store.load(self))
+
+	def __len__(self):
+		return len(self.store.load(self))
+
+	def __repr__(self):
+		return repr(self.store.load(self))
+
+	# Stored records are compared by identity, which is all the store needs
+	__eq__ = object.__eq__
+	__hash__ = object.__hash__
+
+	# Pickled (for the parse cache or worker processes) as the decoded dict
+	def __reduce__(self):
+		return (dict, (dict(self.store.load(self)),))
+
+# The RecordStore of the records parsed with -recordcache, None otherwise
+RECORD_STORE = None
+
+# Returns the RecordStore to add StoredRecords to, starting one if needed
+def getRecordStore():
+	global RECORD_STORE
+	if RECORD_STORE is None:
+		RECORD_STORE = RecordStore(SETTINGS['recordcache'], int(SETTINGS['recordcachemb'] * 1048576))
+	return RECORD_STORE
+
+# Memory-mapped counterpart of parseREFR
+def parseREFRBuf(buf, pos):
+	name, size, flags, formid, vcontrol, formvs, vcontrol2 = RECORD_HEADER.unpack_from(buf, pos)
+	result = {}
+
+	for subName, subData in iterSubrecords(*getRecordData(buf, pos, size, flags)):
+		if subName == b'NAME': # FormID of referenced object
+			result['NAME'] = UINT32.unpack_from(subData)[0]
+		elif subName == b'DATA': # Location/Rotation data
+			xpos, ypos, zpos, radX, radY, radZ = REFR_DATA.unpack_from(subData)
+			degX = math.degrees(round(radX, 5))
+			degY = math.degrees(round(radY, 5))
+			degZ = math.degrees(round(radZ, 5)) + 180
+
+			result['DATA'] = [xpos * SETTINGS['scale'], -ypos * SETTINGS['scale'], zpos * SETTINGS['scale'], degY, degZ, degX]
+			result['XSCL'] = SETTINGS['scale']
+		elif subName == b'XSCL': # Scale (Only present if != 1.0)
+			result['XSCL'] = FLOAT.unpack_from(subData)[0] * SETTINGS['scale']
+		elif subName == b'ONAM': # Open by Default (Only for doors)
+			result['ONAM'] = True
+		elif SETTINGS['allsubs'] or PROFILE is not None:
+			noteUnknownSubrecord(name, subName, subData)
+
+	return result
+
+# Memory-mapped counterparts of parseFuncs
+parseFuncsBuf = {}
+parseFuncsBuf[b'REFR'] = parseREFRBuf
+parseFuncsBuf[b'ACHR'] = parseREFRBuf
+parseFuncsBuf[b'ACRE'] = parseREFRBuf
+
+# Bits of the flags column of a PlacementTable, recording which of the keys
+# parseREFRBuf would have produced are present for a reference
+PLACEMENT_NAME = 0x01
+PLACEMENT_DATA = 0x02
+PLACEMENT_XSCL = 0x04
+PLACEMENT_ONAM = 0x08
+
+# Columnar storage for the placement data of references (see -columnar).
+# Rows hold the raw values from the .ESM and are appended to compact typed
+# arrays while parsing, then turned into a NumPy structured array (if NumPy
+# is available) the first time they are read. The axis flip, radian to
+# degree conversion and scale are applied to whole columns at once. The
+# scale is SETTINGS['scale'] as of when the table was started, so a table
+# reads the same whichever ESMFile is active at the time.
+class PlacementTable(object):
+	# Column name, array module type code and NumPy type
+	FIELDS = [
+		('ref', 'I', 'u4'), # FormID of the reference itself
+		('base', 'I', 'u4'), # FormID of the referenced base record (NAME)
+		('x', 'f', 'f4'), ('y', 'f', 'f4'), ('z', 'f', 'f4'), # Position
+		('rx', 'f', 'f4'), ('ry', 'f', 'f4'), ('rz', 'f', 'f4'), # Rotation in radians
+		('scale', 'f', 'f4'), # Scale, before the table's scale is applied
+		('flags', 'B', 'u1'), # PLACEMENT_* bits
+		('cell', 'I', 'u4'), # FormID of the cell holding the reference
+	]
+
+	def __init__(self, scale=None):
+		self.columns = [array.array(code) for name, code, dtype in self.FIELDS]
+		self.rows = None
+		self.transformed = None
+		self.scale = SETTINGS['scale'] if scale is None else scale
+
+	def __len__(self):
+		return len(self.rows) if self.rows is not None else len(self.columns[0])
+
+	def append(self, *row):
+		for column, value in zip(self.columns, row):
+			column.append(value)
+
+	# True once the table has been converted to a structured array, after
+	# which no more rows can be appended
+	def isFrozen(self):
+		return self.rows is not None
+
+	def freeze(self):
+		if numpy is not None and self.rows is None:
+			rows = numpy.empty(len(self.columns[0]), dtype=[(name, dtype) for name, code, dtype in self.FIELDS])
+			for (name, code, dtype), column in zip(self.FIELDS, self.columns):
+				if len(column):
+					rows[name] = numpy.frombuffer(column, dtype=dtype)
+			self.rows = rows
+			self.columns = None
+
+	# Returns a column by name, as a NumPy array or an array.array
+	def getColumn(self, name):
+		if self.rows is not None:
+			return self.rows[name]
+		return self.columns[[field[0] for field in self.FIELDS].index(name)]
+
+	# Returns the structured array backing the table, for tools that want to
+	# work on the raw placement data directly (None without NumPy)
+	def getArray(self):
+		self.freeze()
+		return self.rows
+
+	# Returns the X, Y, Z, pitch, yaw, roll and scale columns in the form
+	# parseREFRBuf stores them in its DATA and XSCL entries
+	def getTransformed(self):
+		if self.transformed is not None:
+			return self.transformed
+
+		scale = self.scale
+
+		self.freeze()
+		if self.rows is not None:
+			column = lambda name: self.rows[name].astype(numpy.float64)
+			self.transformed = [
+				column('x') * scale,
+				-column('y') * scale,
+				column('z') * scale,
+				numpy.degrees(numpy.round(column('ry'), 5)),
+				numpy.degrees(numpy.round(column('rz'), 5)) + 180,
+				numpy.degrees(numpy.round(column('rx'), 5)),
+				column('scale') * scale,
+			]
+		else:
+			self.transformed = [
+				[x * scale for x in self.getColumn('x')],
+				[-y * scale for y in self.getColumn('y')],
+				[z * scale for z in self.getColumn('z')],
+				[math.degrees(round(r, 5)) for r in self.getColumn('ry')],
+				[math.degrees(round(r, 5)) + 180 for r in self.getColumn('rz')],
+				[math.degrees(round(r, 5)) for r in self.getColumn('rx')],
+				[xscl * scale for xscl in self.getColumn('scale')],
+			]
+
+		return self.transformed
+
+	# Returns a new table holding a copy of rows [start, end)
+	def copyRows(self, start, end):
+		table = PlacementTable(self.scale)
+		if self.rows is not None:
+			table.rows = self.rows[start:end].copy()
+			table.columns = None
+		else:
+			table.columns = [column[start:end] for column in self.columns]
+		return table
+
+	def __getstate__(self):
+		self.freeze()
+		return {'columns' : self.columns, 'rows' : self.rows, 'scale' : self.scale}
+
+	def __setstate__(self, state):
+		self.columns = state['columns']
+		self.rows = state['rows']
+		self.transformed = None
+		self.scale = state['scale']
+
+# The references of one cell children group, stored as rows [start, end) of
+# a PlacementTable. Reads like the list of dicts parseREFRBuf would have
+# produced, with the dicts built on the fly.
+class Placements(collections.abc.Sequence):
+	__slots__ = ('table', 'start', 'end')
+
+	def __init__(self, table, start, end):
+		self.table = table
+		self.start = start
+		self.end = end
+
+	def __len__(self):
+		return self.end - self.start
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return list(self)[i]
+		if i < 0:
+			i += len(self)
+		if i < 0 or i >= len(self):
+			raise IndexError(i)
+
+		return next(self.iterRows(self.start + i, self.start + i + 1))
+
+	def __iter__(self):
+		return self.iterRows(self.start, self.end)
+
+	def iterRows(self, start, end):
+		columns = [column[start:end] for column in self.table.getTransformed()]
+		columns += [self.table.getColumn('base')[start:end], self.table.getColumn('flags')[start:end]]
+		if numpy is not None:
+			columns = [column.tolist() for column in columns]
+
+		for x, y, z, pitch, yaw, roll, xscl, base, flags in zip(*columns):
+			row = {}
+			if flags & PLACEMENT_NAME:
+				row['NAME'] = base
+			if flags & PLACEMENT_DATA:
+				row['DATA'] = [x, y, z, pitch, yaw, roll]
+			if flags & PLACEMENT_XSCL:
+				row['XSCL'] = xscl
+			if flags & PLACEMENT_ONAM:
+				row['ONAM'] = True
+			yield row
+
+	def __repr__(self):
+		return repr(list(self))
+
+	# Only this group's rows are pickled, not the whole table they live in
+	def __reduce__(self):
+		return (Placements, (self.table.copyRows(self.start, self.end), 0, len(self)))
+
+# Table new placement rows are appended to while parsing with -columnar
+placementTable = None
+
+# Returns the table to append placement rows to, starting a new one if
+# there is none yet or the current one has already been read from
+def getPlacementTable():
+	global placementTable
+	if placementTable is None or placementTable.isFrozen():
+		placementTable = PlacementTable()
+	return placementTable
+
+# Columnar counterpart of parseREFRBuf. Appends the raw placement data of
+# the reference at pos to table instead of building a dict for it.
+def parsePlacementBuf(buf, pos, table, cellId):
+	name, size, flags, formid, vcontrol, formvs, vcontrol2 = RECORD_HEADER.unpack_from(buf, pos)
+	base = 0
+	xpos = ypos = zpos = radX = radY = radZ = 0.0
+	scale = 1.0
+	rowFlags = 0
+
+	for subName, subData in iterSubrecords(*getRecordData(buf, pos, size, flags)):
+		if subName == b'NAME': # FormID of referenced object
+			base = UINT32.unpack_from(subData)[0]
+			rowFlags |= PLACEMENT_NAME
+		elif subName == b'DATA': # Location/Rotation data, resets the scale like parseREFRBuf does
+			xpos, ypos, zpos, radX, radY, radZ = REFR_DATA.unpack_from(subData)
+			scale = 1.0
+			rowFlags |= PLACEMENT_DATA | PLACEMENT_XSCL
+		elif subName == b'XSCL': # Scale (Only present if != 1.0)
+			scale = FLOAT.unpack_from(subData)[0]
+			rowFlags |= PLACEMENT_XSCL
+		elif subName == b'ONAM': # Open by Default (Only for doors)
+			rowFlags |= PLACEMENT_ONAM
+		elif SETTINGS['allsubs'] or PROFILE is not None:
+			noteUnknownSubrecord(name, subName, subData)
+
+	table.append(formid, base, xpos, ypos, zpos, radX, radY, radZ, scale, rowFlags, cellId)
+
+# Memory-mapped counterpart of parseCell. Only handles the CELL record itself,
+# its children group is attached by the sub-block that contains both.
+# Exterior cells also get their grid position, as they usually have no EDID.
+def parseCellBuf(buf, pos):
+	name, size, flags, formid, vcontrol, formvs, vcontrol2 = RECORD_HEADER.unpack_from(buf, pos)
+	result = {'FormID' : formid}
+
+	for subName, subData in iterSubrecords(*getRecordData(buf, pos, size, flags)):
+		if subName == b'EDID': # Editor ID
+			result['EDID'] = decodeString(subData)
+		elif subName == b'XCLC': # Exterior grid position
+			result['Grid'] = GRID_DATA.unpack_from(subData)
+		elif PROFILE is not None:
+			noteUnknownSubrecord(name, subName, subData)
+
+	return result
+
+# Parses a World Children group (type 1) at pos, holding a worldspace's
+# persistent cell and its exterior cell blocks. The persistent cell is
+# stored on the WRLD record, blocks go in GRUPS['CELL']['exterior'] keyed by
+# (world FormID, block X, block Y). If deferBlocks is a list the blocks are
+# not parsed but appended to it as (offset, size, key) for the caller.
+def parseWorldChildrenBuf(buf, pos, deferBlocks=None):
+	name, size, label, groupType, timestamp, version = GROUP_HEADER.unpack_from(buf, pos)
+	worldId = UINT32.unpack(label)[0]
+	world = GRUPS['WRLD'].setdefault(worldId, {})
+
+	for childPos, childName in iterEntries(buf, pos + 24, pos + size):
+		if childName == b'CELL': # Persistent cell, holds references that are always loaded
+			world['Persistent'] = parseCellBuf(buf, childPos)
+		elif childName == b'GRUP':
+			childSize, childLabel, childType = GROUP_HEADER.unpack_from(buf, childPos)[1:4]
+			if childType == 6 and 'Persistent' in world: # Cell Children of the persistent cell
+				world['Persistent']['Children'] = parseGroupBuf(buf, childPos)
+			elif childType == 4: # Exterior Cell Block
+				blockY, blockX = GRID_LABEL.unpack(childLabel)
+				key = (worldId, blockX, blockY)
+				if deferBlocks is not None:
+					deferBlocks.append((childPos, childSize, key))
+				else:
+					prefetchBlock(buf, childPos)
+					GRUPS['CELL']['exterior'][key] = parseGroupBuf(buf, childPos)
+
+# Memory-mapped counterpart of parseGroup. pos is the offset of the group's
+# 'GRUP' name. Every group knows its own size, so child groups and records are
+# located by hopping from header to header rather than by peeking at what
+# follows them.
+def parseGroupBuf(buf, pos):
+	name, size, label, groupType, timestamp, version = GROUP_HEADER.unpack_from(buf, pos)
+	end = pos + size
+	pos += 24
+	result = {}
+
+	if groupType == 0: # Top Level Group
+		groupName = label.decode()
+		if groupName == 'CELL': # CELL top group holds all CELL records
+			print('Parsing CELL group of size ' + str(size) + '..')
+
+			blockNum = 0
+			for childPos, childName in iterEntries(buf, pos, end):
+				if childName == b'GRUP' and GROUP_HEADER.unpack_from(buf, childPos)[3] == 2: # Interior Cell Block
+					prefetchBlock(buf, childPos)
+					GRUPS['CELL']['interior'][blockNum] = parseGroupBuf(buf, childPos)
+					blockNum += 1
+
+			# Exterior cells live in the WRLD top group
+
+			return GRUPS['CELL']
+		elif groupName == 'WRLD': # Worldspaces, each followed by a group holding its cells
+			print('Parsing WRLD group of size ' + str(size) + '..')
+
+			for childPos, childName in iterEntries(buf, pos, end):
+				if childName == b'WRLD':
+					parseRecordBuf(buf, childPos, 'WRLD')
+				elif childName == b'GRUP': # World Children
+					parseWorldChildrenBuf(buf, childPos)
+
+			return GRUPS['WRLD']
+		elif groupName in GRUPS: # If group type is supported/parsable/relevant
+			print('Parsing ' + groupName + ' group of size ' + str(size) + '..')
+
+			for childPos, childName in iterEntries(buf, pos, end):
+				if childName == label:
+					parseRecordBuf(buf, childPos, groupName)
+
+			return GRUPS[groupName]
+		else:
+			print('Skipping top group ' + groupName + ' of size ' + str(size) + '..')
+	elif groupType == 2: # Interior Cell Block
+		blockNum = INT32.unpack(label)[0]
+		print('Parsing Block ' + str(blockNum) + ' of size ' + str(size))
+
+		subblock = 0
+		for childPos, childName in iterEntries(buf, pos, end):
+			if childName == b'GRUP': # Interior Cell Sub Block
+				result[subblock] = parseGroupBuf(buf, childPos)
+				subblock += 1
+	elif groupType == 4: # Exterior Cell Block
+		blockY, blockX = GRID_LABEL.unpack(label)
+		print('Parsing Exterior Block ' + str(blockX) + ', ' + str(blockY) + ' of size ' + str(size))
+
+		for childPos, childName in iterEntries(buf, pos, end):
+			if childName == b'GRUP': # Exterior Cell Sub Block
+				subY, subX = GRID_LABEL.unpack_from(buf, childPos + 8)
+				result[(subX, subY)] = parseGroupBuf(buf, childPos)
+	elif groupType == 3 or groupType == 5: # Interior/Exterior Cell Sub Block
+		cellNum = 0
+		for childPos, childName in iterEntries(buf, pos, end):
+			if childName == b'CELL':
+				result[cellNum] = parseCellBuf(buf, childPos)
+				cellNum += 1
+			elif childName == b'GRUP' and cellNum > 0: # Cell Children of the cell we just parsed
+				result[cellNum - 1]['Children'] = parseGroupBuf(buf, childPos)
+	elif groupType == 6: # Cell Children
+		for childPos, childName in iterEntries(buf, pos, end):
+			childType = GROUP_HEADER.unpack_from(buf, childPos)[3]
+			if childType == 8:
+				result['persistent'] = parseGroupBuf(buf, childPos)
+			elif childType == 9:
+				result['temporary'] = parseGroupBuf(buf, childPos)
+			elif childType == 10:
+				result['distant'] = parseGroupBuf(buf, childPos)
+	elif (groupType == 8 or groupType == 9 or groupType == 10) and SETTINGS['columnar']: # Cell Children, stored as placement rows
+		table = getPlacementTable()
+		start = len(table)
+		cellId = UINT32.unpack(label)[0]
+
+		for childPos, childName in iterEntries(buf, pos, end):
+			if childName in parseFuncsBuf:
+				parsePlacementBuf(buf, childPos, table, cellId)
+
+		result = Placements(table, start, len(table))
+	elif groupType == 8 or groupType == 9 or groupType == 10: # Persistent/Temporary/Visible Distant Cell Children
+		result = []
+		for childPos, childName in iterEntries(buf, pos, end):
+			if childName in parseFuncsBuf: # If the child is parsable/relevant
+				result.append(parseFuncsBuf[childName](buf, childPos))
+	else:
+		print('Unknown group of size ' + str(size) + ' and type ' + str(groupType) + '!')
+
+	return result
+
+# Inflates any compressed records within the group at pos that we are
+# going to parse, then parses the group
+def parseGroupPrefetched(buf, pos):
+	prefetchGroup(buf, pos)
+	return parseGroupBuf(buf, pos)
+
+# Inflates any compressed records within the group at pos that we are going
+# to parse, and starts a new placement table for the references in it. The
+# cell blocks of the CELL and WRLD top groups are left to prefetchBlock, so
+# only one block's worth of inflated records is held at a time.
+def prefetchGroup(buf, pos):
+	global placementTable
+	placementTable = None
+
+	size, label, groupType = GROUP_HEADER.unpack_from(buf, pos)[1:4]
+	prefetchCompressed(buf, pos + 24, pos + size, groupType == 0 and label in (b'CELL', b'WRLD'))
+
+# Inflates the compressed records of the interior/exterior cell block at pos
+# ahead of parsing it (see prefetchGroup)
+def prefetchBlock(buf, pos):
+	size = GROUP_HEADER.unpack_from(buf, pos)[1]
+	prefetchCompressed(buf, pos + 24, pos + size)
+
+# Memory-mapped counterpart of the parseESM loop
+def parseESMBuf(buf):
+	for pos, name in iterEntries(buf, 0, len(buf)):
+		if name == b'GRUP':
+			size, label = GROUP_HEADER.unpack_from(buf, pos)[1:3]
+			with profileSection('groups', label.decode('utf-8', 'replace'), size):
+				parseGroupPrefetched(buf, pos)
+		# The only top level records are irrelevant to us, so skip them
+
+	print("Finished parsing file.")
+
+# Parses every top group except CELL and WRLD, which hold the cells that
+# iterCellsStreamed parses on demand
+def parseBaseGroupsBuf(buf):
+	for pos, name in iterEntries(buf, 0, len(buf)):
+		if name == b'GRUP' and GROUP_HEADER.unpack_from(buf, pos)[2] not in (b'CELL', b'WRLD'):
+			parseGroupPrefetched(buf, pos)
+
+# Streaming counterpart of iterCellManifests. Yields the same (cell,
+# directory) pairs, but parses them straight from the .ESM as it goes
+# instead of from GRUPS, so only a sub-block worth of cells (or one tile,
+# for tiles spanning several blocks) is held at a time. Worldspace records
+# are added to GRUPS['WRLD'] as they are reached.
+def iterCellsStreamed(buf):
+	for pos, name in iterEntries(buf, 0, len(buf)):
+		if name != b'GRUP':
+			continue
+
+		size, label = GROUP_HEADER.unpack_from(buf, pos)[1:3]
+		if label == b'CELL':
+			print('Streaming CELL group of size ' + str(size) + '..')
+			yield from iterInteriorCellsStreamed(buf, pos)
+		elif label == b'WRLD':
+			print('Streaming WRLD group of size ' + str(size) + '..')
+			for childPos, childName in iterEntries(buf, pos + 24, pos + size):
+				if childName == b'WRLD':
+					parseRecordBuf(buf, childPos, 'WRLD')
+				elif childName == b'GRUP': # World Children
+					yield from iterWorldTilesStreamed(buf, childPos)
+
+# Yields the interior cells of the CELL top group at pos, numbering blocks
+# and sub-blocks the way parseGroupBuf does
+def iterInteriorCellsStreamed(buf, pos):
+	blockNum = 0
+	for blockPos, blockName in iterEntries(buf, pos + 24, pos + GROUP_HEADER.unpack_from(buf, pos)[1]):
+		blockSize, blockLabel, blockType = GROUP_HEADER.unpack_from(buf, blockPos)[1:4]
+		if blockName != b'GRUP' or blockType != 2: # Interior Cell Block
+			continue
+
+		subNum = 0
+		for subPos, subName in iterEntries(buf, blockPos + 24, blockPos + blockSize):
+			if subName == b'GRUP': # Interior Cell Sub Block
+				for cell in iterSubBlockCellsBuf(buf, subPos):
+					yield cell, 'cells/' + str(blockNum) + '/' + str(subNum) + '/'
+				subNum += 1
+		blockNum += 1
+
+# Yields the exterior tiles of the World Children group at pos, as
+# iterWorldTiles would. Tiles are put together and yielded as soon as every
+# cell they can cover has been read: after each sub-block when tiles fit in
+# one (8 x 8 cells), after each block when they fit in one (32 x 32 cells),
+# otherwise once the whole worldspace has been read.
+def iterWorldTilesStreamed(buf, pos):
+	size, label = GROUP_HEADER.unpack_from(buf, pos)[1:3]
+	worldId = UINT32.unpack(label)[0]
+	world = GRUPS['WRLD'].setdefault(worldId, {})
+	worldName = world.get('EDID', '%08X' % worldId)
+	tileSize = SETTINGS['tile']
+	persistentCell = None
+	persistent = {}
+	cells = []
+
+	for childPos, childName in iterEntries(buf, pos + 24, pos + size):
+		if childName == b'CELL': # Persistent cell, the group after it holds its references
+			prefetchCompressed(buf, childPos, childPos + 24 + RECORD_HEADER.unpack_from(buf, childPos)[1])
+			persistentCell = world['Persistent'] = parseCellBuf(buf, childPos)
+			continue
+		elif childName != b'GRUP':
+			continue
+
+		childSize, childLabel, childType = GROUP_HEADER.unpack_from(buf, childPos)[1:4]
+		if childType == 6 and persistentCell is not None: # Cell Children of the persistent cell
+			prefetchGroup(buf, childPos)
+			persistentCell['Children'] = parseGroupBuf(buf, childPos)
+			persistent = bucketPersistentRefs(persistentCell, tileSize)
+		elif childType == 4: # Exterior Cell Block
+			for subPos, subName in iterEntries(buf, childPos + 24, childPos + childSize):
+				if subName == b'GRUP': # Exterior Cell Sub Block
+					cells.extend(iterSubBlockCellsBuf(buf, subPos))
+					if 8 % tileSize == 0:
+						yield from iterTiles(worldName, cells, persistent, tileSize)
+						cells = []
+
+			if 32 % tileSize == 0:
+				yield from iterTiles(worldName, cells, persistent, tileSize)
+				cells = []
+
+	yield from iterTiles(worldName, cells, persistent, tileSize, True)
+
+# Yields the cells of the Interior/Exterior Cell Sub Block at pos one at a
+# time, each with the children group following it
+def iterSubBlockCellsBuf(buf, pos):
+	global placementTable
+	prefetchGroup(buf, pos)
+
+	cell = None
+	for childPos, childName in iterEntries(buf, pos + 24, pos + GROUP_HEADER.unpack_from(buf, pos)[1]):
+		if childName == b'CELL':
+			if cell is not None:
+				yield cell
+			cell = parseCellBuf(buf, childPos)
+		elif childName == b'GRUP' and cell is not None: # Cell Children of the cell we just parsed
+			placementTable = None # The previous cell may be written out before this one is done
+			cell['Children'] = parseGroupBuf(buf, childPos)
+
+	if cell is not None:
+		yield cell
+
+# Memory-mapped view of the .ESM owned by each parse worker process
+workerBuf = None
+
+# Process pool initializer for parallel parsing. Every worker maps the
+# .ESM itself, so tasks only need to carry an offset.
+def initParseWorker(filepath, settings):
+	global workerBuf
+	SETTINGS.update(settings)
+	workerBuf = mapESM(filepath)
+
+# Process pool task for parallel parsing. Parses the top group or cell
+# block at pos and returns the result to be merged by the parent.
+def parseGroupTask(pos):
+	result = parseGroupPrefetched(workerBuf, pos)
+
+	label, groupType = GROUP_HEADER.unpack_from(workerBuf, pos)[2:4]
+	if groupType == 0: # Top groups are stored in GRUPS, don't hold on to them once they've been sent back
+		GRUPS[label.decode()] = {}
+
+	return result
+
+# Number of worker processes to parse and generate with (0 = one per CPU),
+# a single process unless -jobs is given
+def getJobs():
+	return 1 if SETTINGS['jobs'] is None else SETTINGS['jobs']
+
+# Parallel counterpart of parseESMBuf. Group sizes tell us where every top
+# group and interior/exterior cell block starts and ends, so each one is handed to a
+# pool of jobs worker processes (0 = one per CPU) and the results are merged
+# back into GRUPS in file order once they are all done.
+def parseESMParallel(filepath, jobs):
+	if jobs <= 0:
+		jobs = os.cpu_count() or 1
+
+	tasks = [] # Offset, size and where to merge the result (top group name, interior block number or exterior block key)
+	with mappedESM(filepath) as buf:
+		for pos, name in iterEntries(buf, 0, len(buf)):
+			if name != b'GRUP': # The only top level records are irrelevant to us, so skip them
+				continue
+
+			size, label = GROUP_HEADER.unpack_from(buf, pos)[1:3]
+			groupName = label.decode()
+			if groupName == 'CELL':
+				print('Parsing CELL group of size ' + str(size) + '..')
+
+				blockNum = 0
+				for childPos, childName in iterEntries(buf, pos + 24, pos + size):
+					childSize, childLabel, childType = GROUP_HEADER.unpack_from(buf, childPos)[1:4]
+					if childName == b'GRUP' and childType == 2: # Interior Cell Block
+						tasks.append((childPos, childSize, blockNum))
+						blockNum += 1
+			elif groupName == 'WRLD': # Worldspace records and persistent cells are parsed here, exterior blocks by the workers
+				print('Parsing WRLD group of size ' + str(size) + '..')
+
+				for childPos, childName in iterEntries(buf, pos + 24, pos + size):
+					if childName == b'WRLD':
+						parseRecordBuf(buf, childPos, 'WRLD')
+					elif childName == b'GRUP': # World Children
+						parseWorldChildrenBuf(buf, childPos, tasks)
+			elif groupName in GRUPS:
+				tasks.append((pos, size, groupName))
+			else:
+				print('Skipping top group ' + groupName + ' of size ' + str(size) + '..')
+
+	print('Parsing ' + str(len(tasks)) + ' groups with ' + str(jobs) + ' jobs..')
+	results = {}
+	with concurrent.futures.ProcessPoolExecutor(jobs, initializer=initParseWorker, initargs=(filepath, SETTINGS)) as pool:
+		# Start the biggest groups first so a large one doesn't end up running on its own at the end
+		futures = {pool.submit(parseGroupTask, pos) : pos for pos, size, target in sorted(tasks, key=lambda t: -t[1])}
+		for future in concurrent.futures.as_completed(futures):
+			results[futures[future]] = future.result()
+
+	for pos, size, target in tasks:
+		if isinstance(target, str):
+			GRUPS[target].update(results[pos])
+		elif isinstance(target, tuple):
+			GRUPS['CELL']['exterior'][target] = results[pos]
+		else:
+			GRUPS['CELL']['interior'][target] = results[pos]
+
+	print("Finished parsing file.")
+
+# Memory-maps an .ESM file and returns a memoryview over its contents. The
+# mapping stays open for as long as the view (or any slice of it) is alive.
+def mapESM(filepath):
+	f = open(filepath, 'rb')
+	try:
+		return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+	finally:
+		f.close() # The mapping keeps its own handle
+
+# Memory-maps an .ESM file and yields a memoryview over its contents,
+# releasing the view and the mapping once the caller is done with it.
+@contextlib.contextmanager
+def mappedESM(filepath):
+	f = open(filepath, 'rb')
+	mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	buf = memoryview(mm)
+	try:
+		yield buf
+	finally:
+		buf.release()
+		mm.close()
+		f.close()
+
+# Builds the offset index of a memory-mapped .ESM. This only reads the
+# headers of records and groups and uses their sizes to hop from one to the
+# next, so it is much cheaper than a full parse. Returns a list of IndexEntry
+# in file order, where parent is the position of the enclosing group in the
+# list (or -1 for top level entries).
+def buildIndex(buf):
+	entries = []
+	typeNames = {}
+	stack = [(len(buf), -1, b'\x00\x00\x00\x00', -1)] # End offset, parent, label and type of each open group
+	pos = 0
+
+	while pos < len(buf):
+		while pos >= stack[-1][0]: # Close groups we've walked past
+			stack.pop()
+		end, parent, parentLabel, parentType = stack[-1]
+
+		name, size, label, groupType = GROUP_HEADER.unpack_from(buf, pos)[:4]
+		if name not in typeNames:
+			typeNames[name] = name.decode()
+
+		if name == b'GRUP':
+			entries.append(IndexEntry('GRUP', 0, label, groupType, pos, size, 0, parent))
+			stack.append((pos + size, len(entries) - 1, label, groupType))
+			pos += 24
+		else:
+			flags, formid = RECORD_HEADER.unpack_from(buf, pos)[2:4]
+			entries.append(IndexEntry(typeNames[name], formid, parentLabel, parentType, pos, size + 24, flags, parent))
+			pos += size + 24
+
+	return entries
+
+# Returns the path the offset index of an .ESM is persisted to
+def getIndexPath(filepath):
+	return filepath + '.idx'
+
+# Writes an offset index next to its .ESM. The .ESM size and modification
+# time are stored in the header so stale indexes can be detected on load.
+def saveIndex(filepath, entries):
+	stat = os.stat(filepath)
+	f = open(getIndexPath(filepath), 'wb')
+	try:
+		f.write(INDEX_HEADER.pack(b'UE4FOIDX', INDEX_VERSION, stat.st_size, stat.st_mtime_ns, len(entries)))
+		f.write(b''.join(INDEX_ENTRY.pack(e.type.encode(), e.formid, e.label, e.groupType, e.offset, e.size, e.flags, e.parent) for e in entries))
+	finally:
+		f.close()
+
+# Loads the persisted offset index of an .ESM. Returns None if there isn't
+# one or if the .ESM has changed since it was written.
+def loadIndex(filepath):
+	indexPath = getIndexPath(filepath)
+	if not os.path.isfile(indexPath):
+		return None
+
+	f = open(indexPath, 'rb')
+	try:
+		data = f.read()
+	finally:
+		f.close()
+
+	if len(data) < INDEX_HEADER.size:
+		return None
+
+	stat = os.stat(filepath)
+	magic, version, esmSize, esmTime, count = INDEX_HEADER.unpack_from(data)
+	if magic != b'UE4FOIDX' or version != INDEX_VERSION or esmSize != stat.st_size or esmTime != stat.st_mtime_ns:
+		return None
+	if len(data) != INDEX_HEADER.size + count * INDEX_ENTRY.size:
+		return None
+
+	typeNames = {}
+	entries = []
+	for rtype, formid, label, groupType, offset, size, flags, parent in INDEX_ENTRY.iter_unpack(memoryview(data)[INDEX_HEADER.size:]):
+		if rtype not in typeNames:
+			typeNames[rtype] = rtype.decode()
+		entries.append(IndexEntry(typeNames[rtype], formid, label, groupType, offset, size, flags, parent))
+
+	return entries
+
+# Returns the offset index for a memory-mapped .ESM, loading it from disk if
+# it is up to date or building (and persisting) a new one otherwise.
+# The result is a dict holding the list of entries and lookup tables:
+# 'groups' maps (group type, raw label) to an entry position for top groups
+# and the groups labelled by FormID (world/cell/topic children), while
+# 'records' maps FormIDs to entry positions and is filled by findRecord.
+def openIndex(filepath, buf):
+	with profileSection('phases', 'offset index', len(buf)):
+		entries = loadIndex(filepath)
+		if entries is None:
+			print('Building offset index..')
+			entries = buildIndex(buf)
+			try:
+				saveIndex(filepath, entries)
+			except OSError as e:
+				print('Unable to save offset index: ' + str(e))
+
+	groups = {}
+	for i, e in enumerate(entries):
+		if e.type == 'GRUP' and e.groupType in (0, 1, 6, 7, 8, 9, 10):
+			groups[(e.groupType, e.label)] = i
+
+	return {'entries' : entries, 'groups' : groups, 'records' : None}
+
+# Returns the index entry of the record with the given FormID, or None
+def findRecord(index, formid):
+	if index['records'] is None:
+		index['records'] = {e.formid : i for i, e in enumerate(index['entries']) if e.type != 'GRUP'}
+
+	i = index['records'].get(formid)
+	return index['entries'][i] if i is not None else None
+
+# Returns the index entry of a group given its type and label, or None.
+# Labels can be passed as a top group name or a FormID.
+def findGroup(index, groupType, label):
+	if isinstance(label, str):
+		label = label.encode()
+	elif isinstance(label, int):
+		label = UINT32.pack(label)
+
+	i = index['groups'].get((groupType, label))
+	return index['entries'][i] if i is not None else None
+
+# Parses a single top group by seeking straight to it. Returns the parsed
+# group, or None if the .ESM doesn't have it.
+def parseTopGroupIndexed(buf, index, groupName):
+	entry = findGroup(index, 0, groupName)
+	if entry is None:
+		return None
+
+	with profileSection('groups', groupName, entry.size):
+		return parseGroupPrefetched(buf, entry.offset)
+
+# Parses every supported base record top group (everything but CELL)
+def parseBaseRecordsIndexed(buf, index):
+	for groupName in GRUPS:
+		if groupName != 'CELL':
+			parseTopGroupIndexed(buf, index, groupName)
+
+# Parses a single cell and its children by seeking straight to them.
+# Returns the cell in the same form parseCellBuf does, or None if the
+# .ESM has no cell with that FormID.
+def parseCellIndexed(buf, index, formid):
+	entry = findRecord(index, formid)
+	if entry is None or entry.type != 'CELL':
+		return None
+
+	cell = parseCellBuf(buf, entry.offset)
+	children = findGroup(index, 6, formid)
+	if children is not None:
+		cell['Children'] = parseGroupPrefetched(buf, children.offset)
+
+	return cell
+
+# Exports only the cells of an .ESM that match the given patterns (see
+# matchesCell) without parsing all of it. Every cell record is found through
+# the offset index and only its header is decoded, then just the children
+# of the matching cells (and of the cells sharing their exterior tiles) and
+# the base records those reference are parsed before their .T3D files are
+# written (unless -nomanifests is set). Returns the number of matching
+# cells and tiles.
+def exportCellsIndexed(filepath, patterns):
+	if SETTINGS['lazy']: # Lazy records point into the mapping, so it has to stay open
+		return exportCellsIndexedBuf(filepath, mapESM(filepath), patterns)
+
+	with mappedESM(filepath) as buf:
+		return exportCellsIndexedBuf(filepath, buf, patterns)
+
+# Body of exportCellsIndexed, given the memory-mapped .ESM
+def exportCellsIndexedBuf(filepath, buf, patterns):
+	index = openIndex(filepath, buf)
+	entries = index['entries']
+
+	# Number interior blocks and sub-blocks by position like parseGroupBuf,
+	# and decode the header of every cell
+	ordinals = {}
+	counts = {}
+	cells = []
+	for i, e in enumerate(entries):
+		if e.type == 'GRUP' and (e.groupType == 2 or (e.parent >= 0 and entries[e.parent].groupType == 2)):
+			ordinals[i] = counts.get(e.parent, 0)
+			counts[e.parent] = ordinals[i] + 1
+		elif e.type == 'CELL' and e.parent >= 0 and entries[e.parent].groupType in (3, 5):
+			cells.append((e, parseCellBuf(buf, e.offset)))
+
+	manifests = []
+	tiles = {} # (World Children group offset, tile X, tile Y) -> cells
+	matchingTiles = []
+	for e, cell in cells:
+		sub = entries[e.parent]
+		if sub.groupType == 3 and matchesCell(cell, patterns): # Interior Cell Sub Block
+			manifests.append((cell, 'cells/' + str(ordinals[sub.parent]) + '/' + str(ordinals[e.parent]) + '/'))
+		elif sub.groupType == 5 and 'Grid' in cell: # Exterior Cell Sub Block
+			key = (entries[entries[sub.parent].parent].offset, cell['Grid'][0] // SETTINGS['tile'], cell['Grid'][1] // SETTINGS['tile'])
+			tiles.setdefault(key, []).append(cell)
+			if key not in matchingTiles and matchesCell(cell, patterns):
+				matchingTiles.append(key)
+
+	for cell, directory in manifests:
+		children = findGroup(index, 6, cell['FormID'])
+		if children is not None:
+			cell['Children'] = parseGroupPrefetched(buf, children.offset)
+
+	# Exterior cells are exported as part of their tile
+	worlds = {}
+	for key in matchingTiles:
+		worlds.setdefault(key[0], []).extend(tiles[key])
+	for pos, worldCells in worlds.items():
+		manifests.extend(parseTilesIndexed(buf, index, pos, worldCells))
+
+	# Only decode the base records that get placed
+	for cell, directory in manifests:
+		for zoneName, zone in cell.get('Children', {}).items():
+			for child in zone:
+				entry = findRecord(index, child.get('NAME', 0))
+				if entry is not None and entry.type in GRUPS and entry.type not in ('CELL', 'WRLD') and child['NAME'] not in GRUPS[entry.type]:
+					parseRecordBuf(buf, entry.offset, entry.type)
+
+	buildFormIDIndex()
+
+	if not SETTINGS['nomanifests']:
+		print('Exporting ' + str(len(manifests)) + ' matching cells..')
+		with backgroundT3DWriter():
+			for cell, directory in manifests:
+				generateT3D(cell, directory)
+
+	return len(manifests)
+
+# Parses the children of the given exterior cells of the worldspace whose
+# World Children group is at pos, along with its persistent references, and
+# returns the (tile, directory) pairs of the tiles they make up
+def parseTilesIndexed(buf, index, pos, cells):
+	worldId = UINT32.unpack(GROUP_HEADER.unpack_from(buf, pos)[2])[0]
+	world = findRecord(index, worldId)
+	if world is not None and worldId not in GRUPS['WRLD']:
+		parseRecordBuf(buf, world.offset, 'WRLD')
+	worldName = GRUPS['WRLD'].get(worldId, {}).get('EDID', '%08X' % worldId)
+
+	for cell in cells:
+		children = findGroup(index, 6, cell['FormID'])
+		if children is not None:
+			cell['Children'] = parseGroupPrefetched(buf, children.offset)
+
+	# The persistent cell is the only cell directly inside the World Children group
+	persistent = {}
+	for childPos, childName in iterEntries(buf, pos + 24, pos + GROUP_HEADER.unpack_from(buf, pos)[1]):
+		if childName == b'CELL':
+			persistentCell = parseCellBuf(buf, childPos)
+			children = findGroup(index, 6, persistentCell['FormID'])
+			if children is not None:
+				persistentCell['Children'] = parseGroupPrefetched(buf, children.offset)
+			persistent = bucketPersistentRefs(persistentCell, SETTINGS['tile'])
+			break
+
+	return list(iterTiles(worldName, cells, persistent, SETTINGS['tile']))
+
+# Parses a memory-mapped .ESM, through its offset index if enabled
+def parseESMMapped(filepath, buf):
+	if usesRecordStore():
+		parseESMStored(buf)
+	elif SETTINGS['index']:
+		index = openIndex(filepath, buf)
+		parseBaseRecordsIndexed(buf, index)
+		parseTopGroupIndexed(buf, index, 'CELL')
+		print("Finished parsing file.")
+	else:
+		parseESMBuf(buf)
+
+# True if base records are left to a RecordStore (see -recordcache)
+def usesRecordStore():
+	return SETTINGS['mmap'] and (SETTINGS['recordcache'] > 0 or SETTINGS['recordcachemb'] > 0)
+
+# Counterpart of parseESMBuf for -recordcache. Every record of the supported
+# base record top groups (not worldspaces, which get their persistent cell
+# attached) is added to GRUPS as a StoredRecord, found by hopping over the
+# record headers instead of decoding it. The CELL and WRLD top groups are
+# parsed from where they start. No offset index is built, as it would hold
+# an entry for every reference for as long as the records are in use.
+def parseESMStored(buf):
+	store = getRecordStore()
+	for pos, name in iterEntries(buf, 0, len(buf)):
+		if name != b'GRUP':
+			continue
+
+		size, label = GROUP_HEADER.unpack_from(buf, pos)[1:3]
+		groupName = label.decode('utf-8', 'replace')
+		if label == b'CELL' or label == b'WRLD':
+			with profileSection('groups', groupName, size):
+				parseGroupPrefetched(buf, pos)
+		elif groupName in GRUPS:
+			print('Storing ' + groupName + ' group of size ' + str(size) + '..')
+			group = GRUPS[groupName]
+			for childPos, childName in iterEntries(buf, pos + 24, pos + size):
+				if childName == label:
+					group[RECORD_HEADER.unpack_from(buf, childPos)[3]] = StoredRecord(store, buf, childPos, groupName)
+
+	print("Finished parsing file.")
+
+# Opens the plugin (.ESM or .ESP) at position pluginIndex of the load order:
+# maps it, opens its offset index and reads its masters from the TES4
+# header. Returns a dict describing the plugin, see loadPlugins.
+def openPlugin(filepath, pluginIndex):
+	buf = mapESM(filepath) # Kept open, records are read from it until every plugin is loaded
+	plugin = {
+		'path' : filepath,
+		'name' : os.path.basename(filepath).lower(),
+		'loadIndex' : pluginIndex,
+		'buf' : buf,
+		'index' : openIndex(filepath, buf),
+		'masters' : readMastersBuf(buf),
+	}
+
+	return plugin
+
+# Returns the master files listed in the TES4 header of a mapped plugin
+def readMastersBuf(buf):
+	masters = []
+	name, size, flags = RECORD_HEADER.unpack_from(buf, 0)[:3]
+	if name == b'TES4':
+		for subName, subData in iterSubrecords(*getRecordData(buf, 0, size, flags)):
+			if subName == b'MAST': # Master file name
+				masters.append(decodeString(subData))
+
+	return masters
+
+# Returns a FormID of a plugin as a FormID of the load order. The top byte
+# of a FormID indexes the plugin's own list of masters, or is past its end
+# for records the plugin adds itself, and becomes the load order position
+# of that master (or the plugin).
+def remapFormID(plugin, formid):
+	if formid == 0: # Null reference
+		return formid
+	return (plugin['remap'][formid >> 24] << 24) | (formid & 0xFFFFFF)
+
+# Parses a load order of plugins, which may override (or delete) the records
+# of the plugins before them, and populates GRUPS with the winning version of
+# every record, by load order FormID. Only the offset indexes of the plugins
+# are walked to find the winners, so every record is only decoded once, from
+# the last plugin to touch it. With pluginCellsOnly, only the cells the last
+# plugin adds or changes are parsed (see -batch). Returns the plugins (see
+# openPlugin), or None if a plugin is missing a master.
+def loadPlugins(filepaths, pluginCellsOnly=False):
+	if len(filepaths) > 255:
+		print('Too many plugins, the load order holds at most 255.')
+		return None
+
+	plugins = []
+	for pluginIndex, filepath in enumerate(filepaths):
+		print('Loading plugin ' + str(pluginIndex) + ': ' + filepath + '..')
+		plugins.append(openPlugin(filepath, pluginIndex))
+
+	loadIndexes = {plugin['name'] : plugin['loadIndex'] for plugin in plugins}
+	for plugin in plugins:
+		remap = []
+		for master in plugin['masters']:
+			if master.lower() not in loadIndexes or loadIndexes[master.lower()] >= plugin['loadIndex']:
+				print(plugin['path'] + ' requires ' + master + ', which has to be loaded before it.')
+				return None
+			remap.append(loadIndexes[master.lower()])
+
+		plugin['remap'] = remap + [plugin['loadIndex']] * (256 - len(remap))
+
+	cellIds = None
+	if pluginCellsOnly:
+		cellIds = set(remapFormID(plugins[-1], entry.formid) for entry in plugins[-1]['index']['entries'] if entry.type == 'CELL')
+
+	winners, withChildren = resolveOverrides(plugins)
+	parseWinningRecords(plugins, winners, withChildren, cellIds)
+	print('Finished parsing ' + str(len(plugins)) + ' plugins.')
+
+	buildFormIDIndex()
+	return plugins
+
+# Finds the plugin holding the winning version of every record we parse,
+# from the offset indexes. Returns a dict of load order FormID to (plugin,
+# index entry), in the order the records first appear in the load order,
+# and the set of cells that have a children group in any plugin.
+def resolveOverrides(plugins):
+	wanted = set(GRUPS) | {'REFR'} | set(name.decode() for name in parseFuncsBuf)
+	winners = {}
+	withChildren = set()
+	overrides = 0
+
+	for plugin in plugins:
+		for entry in plugin['index']['entries']:
+			if entry.type == 'GRUP':
+				if entry.groupType == 6: # Cell Children
+					withChildren.add(remapFormID(plugin, UINT32.unpack(entry.label)[0]))
+			elif entry.type in wanted:
+				formid = remapFormID(plugin, entry.formid)
+				if formid in winners:
+					overrides += 1
+				winners[formid] = (plugin, entry) # Keeps the position of the first version
+
+	print('Resolved ' + str(len(winners)) + ' records, ' + str(overrides) + ' overridden by later plugins..')
+	return winners, withChildren
+
+# Decodes the winning version of every record into GRUPS, the same way
+# parseESM would have for a single .ESM. Cells are placed in the block and
+# sub-block of the plugin their winning version comes from, and get the
+# winning versions of every reference that names them as their cell. If
+# cellIds is a set, only the cells in it and their references are parsed.
+# Base records decoded ahead of time by decodeMasterRecords are copied
+# rather than decoded again.
+def parseWinningRecords(plugins, winners, withChildren, cellIds=None):
+	cells = {}
+	interior = {} # Block label -> sub-block label -> cell index -> cell
+	children = {} # Cell FormID -> zone -> [(plugin, index entry)]
+	zoneNames = {8 : 'persistent', 9 : 'temporary', 10 : 'distant'}
+
+	for formid, (plugin, entry) in winners.items():
+		if entry.flags & DELETED_FLAG:
+			continue
+
+		buf = plugin['buf']
+		if entry.type == 'CELL':
+			if cellIds is not None and formid not in cellIds:
+				placeCellIndexed(plugin, entry, None, interior) # Keeps the numbering of the blocks and sub-blocks
+				continue
+			cell = cells[formid] = parseCellBuf(buf, entry.offset)
+			cell['FormID'] = formid
+			placeCellIndexed(plugin, entry, cell, interior)
+		elif entry.type in GRUPS and entry.type != 'WRLD' and usesRecordStore():
+			GRUPS[entry.type][formid] = StoredRecord(getRecordStore(), buf, entry.offset, entry.type, plugin)
+		elif entry.type in GRUPS:
+			record = MASTER_RECORDS.get(plugin['path'], {}).get(entry.offset)
+			record = dict(record) if record is not None else decodeRecordBuf(buf, entry.offset, entry.type)
+			GRUPS[entry.type][formid] = record
+			remapRecord(plugin, record)
+		elif entry.groupType in zoneNames: # Reference, grouped by the cell it's in
+			cellId = remapFormID(plugin, UINT32.unpack(entry.label)[0])
+			if cellIds is not None and cellId not in cellIds:
+				continue
+			children.setdefault(cellId, {}).setdefault(zoneNames[entry.groupType], []).append((plugin, entry))
+
+	# Blocks are numbered by position like parseGroupBuf does, which matches
+	# the labels of a single .ESM with all of its blocks
+	for blockNum, (blockLabel, block) in enumerate(sorted(interior.items())):
+		GRUPS['CELL']['interior'][blockNum] = {subNum : sub for subNum, (subLabel, sub) in enumerate(sorted(block.items()))}
+
+	for formid, cell in cells.items():
+		if formid in withChildren:
+			cell['Children'] = {}
+		for zoneName, refs in children.get(formid, {}).items():
+			cell.setdefault('Children', {})[zoneName] = parseWinningRefs(refs, formid)
+
+# Files a cell parsed from the load order under its worldspace or interior
+# block, going by the groups that hold its winning version. If cell is None
+# only the block and sub-block it would go in are created.
+def placeCellIndexed(plugin, entry, cell, interior):
+	entries = plugin['index']['entries']
+	sub = entries[entry.parent] if entry.parent >= 0 else None
+
+	if sub is not None and sub.groupType == 1: # Persistent cell of a worldspace
+		worldId = remapFormID(plugin, UINT32.unpack(sub.label)[0])
+		if cell is not None:
+			GRUPS['WRLD'].setdefault(worldId, {})['Persistent'] = cell
+	elif sub is not None and sub.groupType == 3: # Interior Cell Sub Block
+		block = entries[sub.parent]
+		cells = interior.setdefault(INT32.unpack(block.label)[0], {}).setdefault(INT32.unpack(sub.label)[0], {})
+		if cell is not None:
+			cells[len(cells)] = cell
+	elif sub is not None and sub.groupType == 5: # Exterior Cell Sub Block
+		block = entries[sub.parent]
+		world = entries[block.parent]
+		blockY, blockX = GRID_LABEL.unpack(block.label)
+		subY, subX = GRID_LABEL.unpack(sub.label)
+		key = (remapFormID(plugin, UINT32.unpack(world.label)[0]), blockX, blockY)
+		cells = GRUPS['CELL']['exterior'].setdefault(key, {}).setdefault((subX, subY), {})
+		if cell is not None:
+			cells[len(cells)] = cell
+
+# Parses the winning versions of the references of one zone of a cell, as
+# (plugin, index entry) pairs, into the list (or placement rows) that
+# parseGroupBuf would have produced
+def parseWinningRefs(refs, cellId):
+	if not SETTINGS['columnar']:
+		result = []
+		for plugin, entry in refs:
+			ref = parseFuncsBuf[entry.type.encode()](plugin['buf'], entry.offset)
+			if 'NAME' in ref:
+				ref['NAME'] = remapFormID(plugin, ref['NAME'])
+			result.append(ref)
+		return result
+
+	table = getPlacementTable()
+	start = len(table)
+	for plugin, entry in refs:
+		parsePlacementBuf(plugin['buf'], entry.offset, table, cellId)
+		for column in ('ref', 'base'):
+			table.getColumn(column)[-1] = remapFormID(plugin, table.getColumn(column)[-1])
+
+	return Placements(table, start, len(table))
+
+# Remaps the FormIDs held by a decoded base record (see decodeBaseSubrecord)
+def remapRecord(plugin, record):
+	if 'CNTO' in record:
+		record['CNTO'] = {remapFormID(plugin, formid) : count for formid, count in record['CNTO'].items()}
+	for subName in ('SNAM', 'QNAM'):
+		if subName in record:
+			record[subName] = remapFormID(plugin, record[subName])
+
 # Initiates the parsing of the supplied .ESM file
 def parseESM(filepath):
+	if SETTINGS['mmap'] and getJobs() != 1 and not usesRecordStore() and os.path.getsize(filepath) > 0:
+		parseESMParallel(filepath, getJobs())
+		return
+
+	if SETTINGS['mmap'] and os.path.getsize(filepath) > 0:
+		if SETTINGS['lazy'] or usesRecordStore(): # Lazy and stored records point into the mapping, so it has to stay open
+			parseESMMapped(filepath, mapESM(filepath))
+		else:
+			with mappedESM(filepath) as buf:
+				parseESMMapped(filepath, buf)
+		return
+
 	f = open(filepath, 'rb')
 	try:
 		while True:
@@ -341,6 +1912,341 @@ def parseESM(filepath):
 	finally:
 		f.close()
 
+# Returns the path the parse cache of an .ESM is persisted to
+def getCachePath(filepath):
+	return filepath + '.cache'
+
+# Returns a SHA-1 hex digest of the contents of an .ESM
+def hashESM(filepath):
+	h = hashlib.sha1()
+	f = open(filepath, 'rb')
+	try:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			h.update(chunk)
+	finally:
+		f.close()
+
+	return h.hexdigest()
+
+# Writes the parsed GRUPS next to the .ESM. The file holds two pickles: a
+# small header describing the .ESM and settings it was parsed with, followed
+# by GRUPS itself, so validating a cache doesn't require loading all of it.
+def saveParseCache(filepath, esmHash=None):
+	stat = os.stat(filepath)
+	header = {
+		'version' : CACHE_VERSION,
+		'path' : os.path.abspath(filepath),
+		'size' : stat.st_size,
+		'mtime' : stat.st_mtime_ns,
+		'hash' : esmHash or hashESM(filepath),
+		'scale' : SETTINGS['scale'],
+	}
+
+	cachePath = getCachePath(filepath)
+	f = open(cachePath + '.tmp', 'wb')
+	try:
+		pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+		pickle.dump(GRUPS, f, pickle.HIGHEST_PROTOCOL)
+	finally:
+		f.close()
+	os.replace(cachePath + '.tmp', cachePath) # Never leave a half written cache behind
+
+# Populates GRUPS from the parse cache of an .ESM. Returns False if there is
+# no cache or it is stale: written by another version of this script, for a
+# different path or scale, or for different .ESM contents. When only the
+# modification time differs the contents are hashed before giving up.
+def loadParseCache(filepath):
+	cachePath = getCachePath(filepath)
+	if not os.path.isfile(cachePath):
+		return False
+
+	stat = os.stat(filepath)
+	f = open(cachePath, 'rb')
+	try:
+		header = pickle.load(f)
+		if not isinstance(header, dict) or header.get('version') != CACHE_VERSION:
+			return False
+		if header['path'] != os.path.abspath(filepath) or header['size'] != stat.st_size or header['scale'] != SETTINGS['scale']:
+			return False
+
+		touched = header['mtime'] != stat.st_mtime_ns
+		if touched and header['hash'] != hashESM(filepath):
+			return False
+
+		data = pickle.load(f)
+	except (pickle.UnpicklingError, EOFError, KeyError, AttributeError, ValueError):
+		return False
+	finally:
+		f.close()
+
+	GRUPS.clear()
+	GRUPS.update(data)
+
+	if touched: # Same contents, refresh the stored modification time so we don't hash again next run
+		saveParseCache(filepath, header['hash'])
+
+	return True
+
+# Populates GRUPS for the supplied .ESM, from the parse cache when it is
+# enabled and up to date, otherwise by parsing the .ESM (and refreshing the
+# cache afterwards), then builds the FormID lookup tables.
+def loadESM(filepath):
+	cached = False
+	if SETTINGS['cache'] and not SETTINGS['rebuildcache'] and not usesRecordStore():
+		with profileSection('phases', 'cache'):
+			cached = loadParseCache(filepath)
+
+	if cached:
+		print('Loaded parsed data from cache.')
+	else:
+		with profileSection('phases', 'parse', os.path.getsize(filepath)):
+			parseESM(filepath)
+
+		if (SETTINGS['cache'] or SETTINGS['rebuildcache']) and not usesRecordStore():
+			print('Saving parse cache..')
+			with profileSection('phases', 'cache'):
+				saveParseCache(filepath)
+
+	with profileSection('phases', 'index'):
+		buildFormIDIndex()
+
+# Streaming counterpart of loadESM followed by writeObjectsToFile and
+# generateCellManifests (see -stream). Base records are parsed first, then
+# the cells are parsed and written out one by one and dropped straight
+# away, so memory use doesn't grow with the number of cells. The parse
+# cache and offset index aren't used, and cells are written by this
+# process alone.
+def streamESM(filepath):
+	if SETTINGS['lazy']: # Lazy records point into the mapping, so it has to stay open
+		streamESMBuf(mapESM(filepath))
+	else:
+		with mappedESM(filepath) as buf:
+			streamESMBuf(buf)
+
+# Body of streamESM, given the memory-mapped .ESM
+def streamESMBuf(buf):
+	parseBaseGroupsBuf(buf)
+	buildFormIDIndex()
+
+	if not SETTINGS['nomanifests']:
+		print('Generating cell manifests..')
+		cells = iterCellsStreamed(buf)
+		if SETTINGS['incremental']:
+			generateCellManifestsIncremental(((directory + getCellName(cell) + '.t3d', (cell, directory)) for cell, directory in cells), 1)
+		else:
+			with backgroundT3DWriter():
+				for cell, directory in cells:
+					generateT3D(cell, directory)
+	elif SETTINGS['dumpgroups'] or SETTINGS['sqlite']:
+		for cell in iterCellsStreamed(buf): # Still needed to find the worldspaces
+			pass
+
+	print("Finished parsing file.")
+
+	# Dumped last, as worldspaces are only parsed along with their cells
+	if SETTINGS['dumpgroups']:
+		writeObjectsToFile()
+	if SETTINGS['sqlite']:
+		writeObjectsToSQLite(SETTINGS['sqlite'])
+
+# Rebuilds the FORMIDS lookup table from GRUPS (and resets EDIDS). Cells
+# are included (with a record type of 'CELL') so they can be found by
+# FormID or Editor ID as well.
+def buildFormIDIndex():
+	FORMIDS.clear()
+	EDIDS.clear()
+	ACTOR_FRAGMENTS.clear()
+	BASE_FINGERPRINTS.clear()
+
+	for rtype, group in GRUPS.items():
+		if rtype == 'CELL':
+			continue
+
+		writer = writeRecToT3DFuncs.get(rtype)
+		for formid, record in group.items():
+			FORMIDS[formid] = (rtype, record, writer)
+
+	cells = [world['Persistent'] for world in GRUPS['WRLD'].values() if 'Persistent' in world]
+	for zoneName, zone in GRUPS['CELL'].items():
+		for blockNum, block in zone.items():
+			for subNum, sub in block.items():
+				cells.extend(sub.values())
+
+	for cell in cells:
+		FORMIDS[cell['FormID']] = ('CELL', cell, None)
+
+# Fills the EDIDS lookup table from FORMIDS. This is left until the first
+# Editor ID lookup, as it means decoding the EDID of every lazy record.
+def buildEDIDIndex():
+	EDIDS.clear()
+	for formid, (rtype, record, writer) in FORMIDS.items():
+		if 'EDID' in record:
+			EDIDS[record['EDID']] = formid
+
+# Yields every parsed cell along with the FormID of its worldspace (None for
+# interior cells): the persistent cell of each worldspace first, then the
+# interior and exterior cells
+def iterCells(grups=None):
+	if grups is None:
+		grups = GRUPS
+
+	for worldId, world in grups['WRLD'].items():
+		if 'Persistent' in world:
+			yield world['Persistent'], worldId
+
+	for zoneName, zone in grups['CELL'].items():
+		for key, block in zone.items():
+			worldId = key[0] if zoneName == 'exterior' else None
+			for subNum, sub in block.items():
+				for cell in sub.values():
+					yield cell, worldId
+
+# Yields a (cell, zone name, reference) tuple for every reference of every
+# parsed cell, in the order of iterCells
+def iterReferences(grups=None):
+	for cell, worldId in iterCells(grups):
+		for zoneName, zone in cell.get('Children', {}).items():
+			for child in zone:
+				yield cell, zoneName, child
+
+# Returns the record with the given FormID, or None if it wasn't parsed
+def lookupFormID(formid):
+	entry = FORMIDS.get(formid)
+	return entry[1] if entry is not None else None
+
+# Returns the FormID of the record with the given Editor ID, or None
+def lookupEDID(edid):
+	if not EDIDS:
+		buildEDIDIndex()
+
+	return EDIDS.get(edid)
+
+# Report of -profile, None unless profiling. Sections of the run are timed
+# into it by profileSection, and saveProfile adds everything else before
+# writing it out as JSON.
+PROFILE = None
+
+# Starts collecting a -profile report, along with cProfile and tracemalloc
+# data if asked for
+def startProfile():
+	global PROFILE
+	PROFILE = {
+		'started' : (time.perf_counter(), time.process_time()),
+		'phases' : {},
+		'groups' : {},
+		'unknownSubrecords' : {},
+	}
+
+	if SETTINGS['cprofile']:
+		import cProfile
+		PROFILE['cprofile'] = cProfile.Profile()
+		PROFILE['cprofile'].enable()
+	if SETTINGS['tracemalloc']:
+		import tracemalloc
+		tracemalloc.start()
+
+# Times the code run within it, adding the wall and CPU time, the number of
+# bytes it covered and the number of calls to section name of a category
+# ('phases' or 'groups') of the -profile report. Does nothing unless profiling.
+@contextlib.contextmanager
+def profileSection(category, name, size=0):
+	if PROFILE is None:
+		yield
+		return
+
+	wall, cpu = time.perf_counter(), time.process_time()
+	try:
+		yield
+	finally:
+		section = PROFILE[category].setdefault(name, {'wall' : 0.0, 'cpu' : 0.0, 'bytes' : 0, 'calls' : 0})
+		section['wall'] += time.perf_counter() - wall
+		section['cpu'] += time.process_time() - cpu
+		section['bytes'] += size
+		section['calls'] += 1
+
+# Reports a subrecord the parser doesn't handle: prints it with -allsubs
+# and counts it by record and subrecord type for -profile
+def noteUnknownSubrecord(rtype, subName, subData):
+	if SETTINGS['allsubs']:
+		print('Unknown ' + rtype.decode() + ' subrecord ' + subName.decode() + ' with data: ' + str(subData, 'utf-8', 'ignore'))
+	if PROFILE is not None:
+		key = rtype.decode('utf-8', 'replace') + '.' + subName.decode('utf-8', 'replace')
+		PROFILE['unknownSubrecords'][key] = PROFILE['unknownSubrecords'].get(key, 0) + 1
+
+# Counts the records of every type in a memory-mapped .ESM by walking the
+# record headers only. Returns the number of compressed records.
+def countRecordsBuf(buf, counts):
+	compressed = 0
+	pos = 0
+	while pos < len(buf):
+		name, size, flags = COMPRESSED_DATA.unpack_from(buf, pos)
+		if name == b'GRUP': # Step inside the group
+			pos += 24
+			continue
+
+		rtype = name.decode('utf-8', 'replace')
+		counts[rtype] = counts.get(rtype, 0) + 1
+		if flags & COMPRESSED_FLAG:
+			compressed += 1
+		pos += size + 24
+
+	return compressed
+
+# Finishes the -profile report for the given plugins and writes it to path.
+# Bytes per second are worked out for every section, and the record counts
+# of the plugins, the peak memory and any cProfile or tracemalloc results
+# are added.
+def saveProfile(path, filepaths):
+	wall, cpu = PROFILE.pop('started')
+	report = {
+		'files' : [{'path' : filepath, 'size' : os.path.getsize(filepath)} for filepath in filepaths],
+		'settings' : {key : value for key, value in SETTINGS.items() if key not in ('profile', 'cprofile')},
+		'wall' : time.perf_counter() - wall,
+		'cpu' : time.process_time() - cpu,
+	}
+
+	for category in ('phases', 'groups'):
+		for section in PROFILE[category].values():
+			section['bytesPerSecond'] = section['bytes'] / section['wall'] if section['wall'] > 0 else 0.0
+		report[category] = PROFILE[category]
+
+	report['records'] = {}
+	report['compressedRecords'] = 0
+	for filepath in filepaths:
+		if os.path.getsize(filepath) > 0:
+			with mappedESM(filepath) as buf:
+				report['compressedRecords'] += countRecordsBuf(buf, report['records'])
+	report['unknownSubrecords'] = PROFILE['unknownSubrecords']
+	if RECORD_STORE is not None:
+		report['recordStore'] = RECORD_STORE.getStats()
+
+	if resource is not None:
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		report['peakRSS'] = peak if sys.platform == 'darwin' else peak * 1024 # Bytes on macOS, KB elsewhere
+
+	if 'cprofile' in PROFILE:
+		import pstats
+		PROFILE['cprofile'].disable()
+		PROFILE['cprofile'].dump_stats(SETTINGS['cprofile'])
+
+		stats = pstats.Stats(PROFILE['cprofile']).stats
+		top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:25]
+		report['hotspots'] = [{'function' : '%s:%d(%s)' % function, 'calls' : calls, 'tottime' : tottime, 'cumtime' : cumtime} for function, (primitive, calls, tottime, cumtime, callers) in top]
+
+	if SETTINGS['tracemalloc']:
+		import tracemalloc
+		report['tracedPeak'] = tracemalloc.get_traced_memory()[1]
+		top = tracemalloc.take_snapshot().statistics('lineno')[:25]
+		report['allocations'] = [{'line' : str(stat.traceback[0]), 'size' : stat.size, 'count' : stat.count} for stat in top]
+		tracemalloc.stop()
+
+	f = open(path, 'w')
+	try:
+		json.dump(report, f, indent=1)
+	finally:
+		f.close()
+	print('Saved profile to ' + path + '.')
+
 # Dumps top groups (not including CELL group) into
 # .txt files. Moslty a debug utility.
 def writeObjectsToFile():
@@ -355,6 +2261,78 @@ def writeObjectsToFile():
 			f.write(str(data))
 			f.close()
 
+# Tables and indexes of the database written by writeObjectsToSQLite.
+# Records of every parsed top group besides CELL (worldspaces included) go
+# in records, with any subrecords not given a column of their own stored
+# as JSON in data. Reference placements are stored the way they are
+# written to .T3D files: scaled, Y flipped and rotated in degrees.
+SQLITE_SCHEMA = """
+CREATE TABLE records (formid INTEGER PRIMARY KEY, type TEXT NOT NULL, edid TEXT, full TEXT, model TEXT, data TEXT);
+CREATE TABLE cells (formid INTEGER PRIMARY KEY, edid TEXT, world INTEGER, gridx INTEGER, gridy INTEGER);
+CREATE TABLE refs (cell INTEGER NOT NULL, zone TEXT NOT NULL, base INTEGER, x REAL, y REAL, z REAL, pitch REAL, yaw REAL, roll REAL, scale REAL, open INTEGER NOT NULL);
+"""
+SQLITE_INDEXES = """
+CREATE INDEX records_type ON records (type);
+CREATE INDEX records_edid ON records (edid);
+CREATE INDEX records_model ON records (model);
+CREATE INDEX cells_edid ON cells (edid);
+CREATE INDEX cells_grid ON cells (world, gridx, gridy);
+CREATE INDEX refs_cell ON refs (cell);
+CREATE INDEX refs_base ON refs (base);
+"""
+
+# Record keys with a column of their own in the records table
+SQLITE_RECORD_COLUMNS = frozenset(['EDID', 'FULL', 'MODL', 'Persistent'])
+
+# Writes the parsed base records, worldspaces, cells and references into an
+# SQLite database at path, replacing any previous one. Rows are streamed
+# into executemany from generators inside a single transaction, and the
+# indexes are only built once everything is in.
+def writeObjectsToSQLite(path):
+	print('Writing SQLite database ' + path + '..')
+	if os.path.exists(path + '.tmp'):
+		os.remove(path + '.tmp')
+
+	db = sqlite3.connect(path + '.tmp')
+	try:
+		db.execute('PRAGMA journal_mode = OFF') # Nothing to roll back to, the file is swapped in at the end
+		db.execute('PRAGMA synchronous = OFF')
+		db.executescript(SQLITE_SCHEMA)
+
+		with db:
+			db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)', iterRecordRows())
+			db.executemany('INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?, ?)', iterCellRows())
+			db.executemany('INSERT INTO refs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', iterRefRows())
+
+		db.executescript(SQLITE_INDEXES)
+	finally:
+		db.close()
+
+	os.replace(path + '.tmp', path)
+
+# Yields a row of the records table for every record outside the CELL group
+def iterRecordRows():
+	for rtype, group in GRUPS.items():
+		if rtype == 'CELL':
+			continue
+
+		for formid, record in group.items():
+			data = {key : value for key, value in record.items() if key not in SQLITE_RECORD_COLUMNS}
+			yield formid, rtype, record.get('EDID'), record.get('FULL'), record.get('MODL'), json.dumps(data) if data else None
+
+# Yields a row of the cells table for every cell
+def iterCellRows():
+	for cell, worldId in iterCells():
+		grid = cell.get('Grid', (None, None))
+		yield cell['FormID'], cell.get('EDID'), worldId, grid[0], grid[1]
+
+# Yields a row of the refs table for every reference of every cell
+def iterRefRows():
+	for cell, zoneName, child in iterReferences():
+		data = child.get('DATA', (None,) * 6)
+		yield (cell['FormID'], zoneName, child.get('NAME'), data[0], data[1], data[2],
+			data[3], data[4], data[5], child.get('XSCL'), 'ONAM' in child)
+
 # Loops through all cells and generates
 # UE4 importable .T3D files
 def generateCellManifests():
@@ -362,23 +2340,291 @@ def generateCellManifests():
 	#if not os.path.exists('cells/'):
 	#	os.makedirs('cells/')
 
-	for zoneName, zone in GRUPS['CELL'].items():
-		for blockNum, block in zone.items():
-			for subNum, sub in block.items():
-				for cellIndex, cell in sub.items():
-					generateT3D(cell, 'cells/' + str(blockNum) + '/' + str(subNum) + '/')
+	if SETTINGS['incremental'] and not SETTINGS['cells']: # Every other cell would look deleted
+		generateCellManifestsIncremental(getCellManifestTasks().items(), getJobs())
+		return
+
+	if getJobs() != 1:
+		generateCellManifestsParallel(getJobs(), list(getCellManifestTasks().values()))
+		return
+
+	with backgroundT3DWriter():
+		for cell, directory in iterCellManifests():
+			generateT3D(cell, directory)
+
+# Gathers every cell in the order iterCellManifests visits them, keyed by the
+# path of their .T3D file. If two cells map to the same file the serial loop
+# lets the last one win, so we do the same here.
+def getCellManifestTasks():
+	tasks = {}
+	for cell, directory in iterCellManifests():
+		tasks[directory + getCellName(cell) + '.t3d'] = (cell, directory)
+
+	return tasks
+
+# Same as generateCellManifests, but only writes the .T3D files whose cell
+# changed since the last incremental export. Each file is fingerprinted
+# (see fingerprintCell) and the fingerprints are saved alongside the files,
+# so the next run can skip every cell with a matching fingerprint and
+# remove the files of cells that no longer exist. tasks holds (path, (cell,
+# directory)) pairs, changed cells are written as they come up unless they
+# are left to a pool of jobs worker processes.
+def generateCellManifestsIncremental(tasks, jobs):
+	exportKey = getExportKey()
+	previous = loadExportManifest()
+	current = {}
+	changed = []
+	written = 0
+
+	with backgroundT3DWriter():
+		for path, task in tasks:
+			current[path] = fingerprintCell(task[0], exportKey)
+			if previous.get(path) != current[path] or not os.path.isfile(path):
+				print(('Updating ' if path in previous else 'Adding ') + path)
+				if jobs != 1:
+					changed.append(task)
+				else:
+					generateT3D(*task)
+				written += 1
+
+	removed = [path for path in previous if path not in current]
+	for path in removed:
+		print('Removing ' + path)
+		if os.path.isfile(path):
+			os.remove(path)
+
+	if changed:
+		generateCellManifestsParallel(jobs, changed)
+
+	# Only saved once every file is written, so an interrupted
+	# export simply picks up the remaining cells next time
+	saveExportManifest(current)
+	print(str(written) + ' cells written, ' + str(len(removed)) + ' removed, ' + str(len(current) - written) + ' unchanged.')
+
+# Returns the {path : fingerprint} of every .T3D file written by the last
+# incremental export, or an empty dict if there was none
+def loadExportManifest():
+	if not os.path.isfile(EXPORT_MANIFEST_PATH):
+		return {}
+
+	f = open(EXPORT_MANIFEST_PATH, 'rb')
+	try:
+		manifest = pickle.load(f)
+	except (pickle.UnpicklingError, EOFError):
+		return {}
+	finally:
+		f.close()
 
-# Generates a single .T3D file given a cell and
-# an optional output directory for the .T3D file
-# (The output directory is intended mostly for debug use)
-def generateT3D(cell, directory=''):
-	if directory != '' and not os.path.exists(directory):
-		os.makedirs(directory)
+	if manifest.get('version') != EXPORT_MANIFEST_VERSION:
+		return {}
+
+	return manifest['cells']
+
+# Saves the {path : fingerprint} of every .T3D file just exported
+def saveExportManifest(cells):
+	os.makedirs(os.path.dirname(EXPORT_MANIFEST_PATH), exist_ok=True)
 
-	# Open our .T3D file and output the "header" for the map
-	f = open(directory + cell['EDID'] + '.t3d', 'w+')
-	f.write("""Begin Map Name=/Game/Maps/""" + cell['EDID'] + """
-Begin Level NAME=PersistentLevel
+	f = open(EXPORT_MANIFEST_PATH + '.tmp', 'wb')
+	try:
+		pickle.dump({'version' : EXPORT_MANIFEST_VERSION, 'cells' : cells}, f, pickle.HIGHEST_PROTOCOL)
+	finally:
+		f.close()
+	os.replace(EXPORT_MANIFEST_PATH + '.tmp', EXPORT_MANIFEST_PATH)
+
+# Hashes everything besides the cells themselves that ends up in a .T3D
+# file: the manifest version, float formatting, scale, instancing and the T3D templates
+def getExportKey():
+	key = (EXPORT_MANIFEST_VERSION, SETTINGS['floatformat'], SETTINGS['scale'], T3D_HEADER, T3D_FOOTER,
+		STATIC_MESH_ACTOR_START, STATIC_MESH_ACTOR_TRANSFORM, STATIC_MESH_ACTOR_SCALE, STATIC_MESH_ACTOR_END,
+		SETTINGS['instance'], INSTANCED_MESH_ACTOR_START, INSTANCED_MESH_ACTOR_INSTANCE, INSTANCED_MESH_ACTOR_END,
+		TARGET_POINT_START, TARGET_POINT_END, POINT_LIGHT_START, POINT_LIGHT_END)
+
+	return hashlib.sha1(repr(key).encode('utf-8')).digest()
+
+# Fingerprints the .T3D file of a cell: its Editor ID, the placement of each
+# reference that gets written and the base record parts they use (record
+# type, Editor ID, model and light data), on top of the export key
+def fingerprintCell(cell, exportKey):
+	h = hashlib.sha1(exportKey)
+	h.update(getCellName(cell).encode('utf-8', 'replace'))
+
+	if 'Children' in cell:
+		for zoneName, zone in cell['Children'].items():
+			h.update(zoneName.encode('utf-8'))
+			for child in zone:
+				entry = FORMIDS.get(child['NAME'])
+				if entry is None or entry[2] is None or 'DATA' not in child:
+					continue # Not written by generateT3D
+
+				h.update(FINGERPRINT_REF.pack(child['NAME'], *child['DATA'], child.get('XSCL', 1.0)))
+				h.update(getBaseFingerprint(child['NAME'], entry))
+
+	return h.hexdigest()
+
+# Returns (and caches) the fingerprint of the parts of a base record
+# that are written to .T3D files, given its FORMIDS entry
+def getBaseFingerprint(formid, entry):
+	fingerprint = BASE_FINGERPRINTS.get(formid)
+	if fingerprint is None:
+		key = (entry[0], entry[1].get('EDID'), entry[1].get('MODL'), entry[1].get('DATA'))
+		fingerprint = BASE_FINGERPRINTS[formid] = hashlib.sha1(repr(key).encode('utf-8')).digest()
+
+	return fingerprint
+
+# Yields a (cell, directory) pair for every .T3D file to generate: one per
+# interior cell, followed by the exterior tiles of every worldspace. Only
+# the cells matching SETTINGS['cells'] (and the tiles holding exterior cells
+# that match) are yielded if there are any patterns in it.
+def iterCellManifests():
+	patterns = SETTINGS['cells']
+	tiles = getMatchingTiles(patterns) if patterns else None
+
+	for blockNum, block in GRUPS['CELL']['interior'].items():
+		for subNum, sub in block.items():
+			for cellIndex, cell in sub.items():
+				if tiles is None or matchesCell(cell, patterns):
+					yield cell, 'cells/' + str(blockNum) + '/' + str(subNum) + '/'
+
+	for worldId in GRUPS['WRLD']:
+		for tile in iterWorldTiles(worldId, SETTINGS['tile']):
+			if tiles is None or tile[0]['EDID'] in tiles:
+				yield tile
+
+# Returns the name of a cell's .T3D file and map: its Editor ID, or its
+# FormID as 8 hex digits if it has none, like worldspaces
+def getCellName(cell):
+	return cell.get('EDID') or '%08X' % cell['FormID']
+
+# Returns True if a cell's Editor ID or FormID matches one of the given
+# patterns. Patterns may hold shell style wildcards and are case insensitive.
+# FormIDs are matched as 8 hex digits, with or without a leading 0x, or by
+# value if the pattern is a plain hex number.
+def matchesCell(cell, patterns):
+	edid = cell.get('EDID', '').lower()
+	formid = '%08x' % cell.get('FormID', 0)
+
+	for pattern in patterns:
+		pattern = pattern.lower()
+		hexPattern = pattern[2:] if pattern.startswith('0x') else pattern
+		if fnmatch.fnmatchcase(edid, pattern) or fnmatch.fnmatchcase(formid, hexPattern):
+			return True
+		if hexPattern and all(c in '0123456789abcdef' for c in hexPattern) and int(hexPattern, 16) == cell.get('FormID'):
+			return True
+
+	return False
+
+# Returns the names of the exterior tiles (see iterWorldTiles) holding a
+# cell that matches one of the given patterns
+def getMatchingTiles(patterns):
+	tiles = set()
+	for (worldId, blockX, blockY), block in GRUPS['CELL']['exterior'].items():
+		worldName = GRUPS['WRLD'].get(worldId, {}).get('EDID', '%08X' % worldId)
+		for subKey, sub in block.items():
+			for cellIndex, cell in sub.items():
+				if 'Grid' in cell and matchesCell(cell, patterns):
+					tiles.add(worldName + '_' + str(cell['Grid'][0] // SETTINGS['tile']) + '_' + str(cell['Grid'][1] // SETTINGS['tile']))
+
+	return tiles
+
+# Yields a (cell, directory) pair for each tile of tileSize x tileSize
+# exterior cells in a worldspace, in grid order. Each tile is a cell-like
+# dict named <world>_<tile X>_<tile Y> whose children are those of all the
+# cells it covers, plus the world's persistent references that are placed
+# within it. Tiles are written to cells/<world>/ so every worldspace can be
+# streamed in piece by piece rather than imported as one huge map.
+def iterWorldTiles(worldId, tileSize):
+	world = GRUPS['WRLD'][worldId]
+	cells = []
+	for key, block in GRUPS['CELL']['exterior'].items():
+		if key[0] == worldId:
+			for subKey, sub in block.items():
+				cells.extend(sub.values())
+
+	return iterTiles(world.get('EDID', '%08X' % worldId), cells, bucketPersistentRefs(world.get('Persistent', {}), tileSize), tileSize, True)
+
+# Persistent references all live in the world's persistent cell, so they
+# are placed in tiles by position instead (undoing the scale and Y flip).
+# Returns the references of the persistent cell keyed by tile.
+def bucketPersistentRefs(cell, tileSize):
+	persistent = {}
+	if 'Children' in cell:
+		for child in cell['Children'].get('persistent', []):
+			if 'DATA' in child:
+				cellX = int(math.floor(child['DATA'][0] / SETTINGS['scale'] / CELL_SIZE))
+				cellY = int(math.floor(-child['DATA'][1] / SETTINGS['scale'] / CELL_SIZE))
+				persistent.setdefault((cellX // tileSize, cellY // tileSize), []).append(child)
+
+	return persistent
+
+# Yields the tiles covering the given exterior cells of a worldspace, in
+# grid order, along with the persistent references (keyed by tile, see
+# bucketPersistentRefs) that belong to them. Persistent references are
+# removed from persistent once placed, allRefs also yields tiles for
+# those left over that aren't covered by any of the cells.
+def iterTiles(worldName, cells, persistent, tileSize, allRefs=False):
+	tiles = {}
+	for cell in cells:
+		if 'Grid' not in cell or 'Children' not in cell:
+			continue
+
+		# Only collect the children lists here, they are merged
+		# when the tile is yielded so just one tile is held at a time
+		tile = tiles.setdefault((cell['Grid'][0] // tileSize, cell['Grid'][1] // tileSize), {})
+		for zoneName, zone in cell['Children'].items():
+			tile.setdefault(zoneName, []).append(zone)
+
+	for key in (list(persistent) if allRefs else [key for key in tiles if key in persistent]):
+		tiles.setdefault(key, {}).setdefault('persistent', []).append(persistent.pop(key))
+
+	for (tileX, tileY), zones in sorted(tiles.items()):
+		children = {zoneName : [child for zone in zoneList for child in zone] for zoneName, zoneList in zones.items()}
+		yield {'EDID' : worldName + '_' + str(tileX) + '_' + str(tileY), 'Children' : children}, 'cells/' + worldName + '/'
+
+# Process pool initializer for parallel .T3D generation. Workers receive the
+# settings and base record groups once, when they start, rather than with
+# every task. (When workers are forked they already share these with the
+# parent, so nothing gets copied at all.)
+def initT3DWorker(settings, baseGroups):
+	SETTINGS.update(settings)
+	GRUPS.update(baseGroups)
+	buildFormIDIndex()
+
+# Process pool task for parallel .T3D generation. Writes a chunk of
+# (cell, directory) pairs and returns the worker's pid and the cell count
+# so the parent can report progress per worker.
+def generateT3DChunk(tasks):
+	with backgroundT3DWriter():
+		for cell, directory in tasks:
+			generateT3D(cell, directory)
+
+	return os.getpid(), len(tasks)
+
+# Same as the serial loop in generateCellManifests, but fans the (cell,
+# directory) tasks out over a pool of jobs worker processes (0 = one per
+# CPU). Only the cells themselves are sent to the workers with each task.
+def generateCellManifestsParallel(jobs, tasks):
+	if jobs <= 0:
+		jobs = os.cpu_count() or 1
+
+	# A few chunks per worker keeps them all busy without paying the
+	# per-task overhead for every single cell
+	chunkSize = max(1, len(tasks) // (jobs * 8))
+	chunks = [tasks[i:i + chunkSize] for i in range(0, len(tasks), chunkSize)]
+	baseGroups = {rtype : group for rtype, group in GRUPS.items() if rtype != 'CELL'}
+
+	print('Generating ' + str(len(tasks)) + ' cells with ' + str(jobs) + ' jobs..')
+	done = 0
+	perWorker = {}
+	with concurrent.futures.ProcessPoolExecutor(jobs, initializer=initT3DWorker, initargs=(SETTINGS, baseGroups)) as pool:
+		for future in concurrent.futures.as_completed([pool.submit(generateT3DChunk, chunk) for chunk in chunks]):
+			pid, count = future.result()
+			done += count
+			perWorker[pid] = perWorker.get(pid, 0) + count
+			print('Worker ' + str(pid) + ' wrote ' + str(perWorker[pid]) + ' cells (' + str(done) + '/' + str(len(tasks)) + ' total)')
+
+# Text shared by every .T3D map, written after the map name and before the
+# actors: the level, its WorldSettings and the default brush
+T3D_HEADER = """Begin Level NAME=PersistentLevel
    Begin Actor Class=WorldSettings Name=WorldSettings Archetype=WorldSettings'/Script/Engine.Default__WorldSettings'
       Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__WorldSettings:StaticMeshComponent0'
       End Object
@@ -463,374 +2709,796 @@ Begin Level NAME=PersistentLevel
       bHidden=False
       RootComponent=BrushComponent0
       ActorLabel="Brush5"
-   End Actor""")
-
-	# Loop through children of the cell and write in the
-	# appropriate UE4 actor data to the map
-	if 'Children' in cell:
-		for zoneName, zone in cell['Children'].items():
-			for child in zone:
-				for groupName, group in GRUPS.items():
-					if child['NAME'] in group and groupName in writeRecToT3DFuncs:
-						writeRecToT3DFuncs[groupName](f, child)
+   End Actor"""
 
-	# Wrap up the .T3D file
-	f.write("""   End Level
+# Text closing every .T3D map
+T3D_FOOTER = """   End Level
 Begin Surface
 End Surface
-End Map""")
-	f.close()
-
-# Static Meshes
-def writeRecToT3D_STAT(f, record):
-	if 'MODL' in GRUPS['STAT'][record['NAME']]:
-		model = GRUPS['STAT'][record['NAME']]['MODL']
-		path, model = os.path.split(model)
-		model = model.replace('.nif', '').replace('.NIF', '')
+End Map"""
 
-		scale = 1.0
-		if 'XSCL' in record:
-			scale = record['XSCL']
-		
-		f.write("""Begin Actor Class=StaticMeshActor Name=""" + str(record['NAME']) + GRUPS['STAT'][record['NAME']]['EDID'] + """ Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
+# A StaticMeshActor, split into the text that only depends on the base
+# record (filled in once per base record by getStaticMeshFragments) and
+# the transform of each reference in between
+STATIC_MESH_ACTOR_START = """Begin Actor Class=StaticMeshActor Name=%(label)s Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
          Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__StaticMeshActor:StaticMeshComponent0'
          End Object
          Begin Object Name="StaticMeshComponent0"
-            StaticMesh=StaticMesh'/Game/Meshes/""" + path + '/' + model + '.' + model + """'
+            StaticMesh=StaticMesh'/Game/Meshes/%(mesh)s'
             StaticMeshDerivedDataKey="STATICMESH_46A8778361B442A9523C54440EA1E9D_0db5412b27ab480f844cc7f0be5abaff_AF050A664CBE58381B1D05B5C07A33E600000000010000000100000000000000010000004000000000000000010000000000803F0000803F0000803F0000803F000000000000803F00000000000000000000344203030300000000"
-            RelativeLocation=(X=""" + str(record['DATA'][0]) + """,Y=""" + str(record['DATA'][1]) + """,Z=""" + str(record['DATA'][2]) + """)
-            RelativeRotation=(Pitch=""" + str(record['DATA'][3]) + """,Yaw=""" + str(record['DATA'][4]) + """,Roll=""" + str(record['DATA'][5]) + """)
-         	RelativeScale3D=(X=""" + str(scale) + """, Y=""" + str(scale) + """, Z=""" + str(scale) + """)
+            """
+STATIC_MESH_ACTOR_TRANSFORM = """RelativeLocation=(X={0},Y={1},Z={2})
+            RelativeRotation=(Pitch={3},Yaw={4},Roll={5})
+         	RelativeScale3D="""
+STATIC_MESH_ACTOR_SCALE = '(X={0}, Y={0}, Z={0})'
+STATIC_MESH_ACTOR_END = """
          End Object
          StaticMeshComponent=StaticMeshComponent0
          RootComponent=StaticMeshComponent0
-         ActorLabel=\"""" + str(record['NAME']) + GRUPS['STAT'][record['NAME']]['EDID'] + """\"
-      End Actor\n""")
-
-# Doors
-def writeRecToT3D_DOOR(f, record):
-	if 'MODL' in GRUPS['DOOR'][record['NAME']]:
-		model = GRUPS['DOOR'][record['NAME']]['MODL']
-		path, model = os.path.split(model)
-		model = model.replace('.nif', '').replace('.NIF', '')
-
-		scale = 1.0
-		if 'XSCL' in record:
-			scale = record['XSCL']
-		
-		f.write("""Begin Actor Class=StaticMeshActor Name=""" + str(record['NAME']) + GRUPS['DOOR'][record['NAME']]['EDID'] + """ Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
-         Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__StaticMeshActor:StaticMeshComponent0'
+         ActorLabel="%(label)s"
+      End Actor\n"""
+
+# An Actor holding a HierarchicalInstancedStaticMeshComponent, which draws
+# every reference of one mesh in a cell (see -instance). Each instance is
+# written as the rows of its transform matrix.
+INSTANCED_MESH_ACTOR_START = """Begin Actor Class=Actor Name=%(label)s Archetype=Actor'/Script/Engine.Default__Actor'
+         Begin Object Class=HierarchicalInstancedStaticMeshComponent Name="HierarchicalInstancedStaticMeshComponent0"
          End Object
-         Begin Object Name="StaticMeshComponent0"
-            StaticMesh=StaticMesh'/Game/Meshes/""" + path + '/' + model + '.' + model + """'
-            StaticMeshDerivedDataKey="STATICMESH_46A8778361B442A9523C54440EA1E9D_0db5412b27ab480f844cc7f0be5abaff_AF050A664CBE58381B1D05B5C07A33E600000000010000000100000000000000010000004000000000000000010000000000803F0000803F0000803F0000803F000000000000803F00000000000000000000344203030300000000"
-            RelativeLocation=(X=""" + str(record['DATA'][0]) + """,Y=""" + str(record['DATA'][1]) + """,Z=""" + str(record['DATA'][2]) + """)
-            RelativeRotation=(Pitch=""" + str(record['DATA'][3]) + """,Yaw=""" + str(record['DATA'][4]) + """,Roll=""" + str(record['DATA'][5]) + """)
-         	RelativeScale3D=(X=""" + str(scale) + """, Y=""" + str(scale) + """, Z=""" + str(scale) + """)
+         Begin Object Name="HierarchicalInstancedStaticMeshComponent0"
+            StaticMesh=StaticMesh'/Game/Meshes/%(mesh)s'
+"""
+INSTANCED_MESH_ACTOR_INSTANCE = """            PerInstanceSMData({0})=(Transform=(XPlane=(W=0,X={1},Y={2},Z={3}),YPlane=(W=0,X={4},Y={5},Z={6}),ZPlane=(W=0,X={7},Y={8},Z={9}),WPlane=(W=1,X={10},Y={11},Z={12})))
+"""
+INSTANCED_MESH_ACTOR_END = """         End Object
+         RootComponent=HierarchicalInstancedStaticMeshComponent0
+         InstanceComponents(0)=HierarchicalInstancedStaticMeshComponent'HierarchicalInstancedStaticMeshComponent0'
+         ActorLabel="%(label)s"
+      End Actor\n"""
+
+# A TargetPoint marking where an NPC (NPC_) or creature (CREA) is placed.
+# Actors are assembled from several models in game, so there is no single
+# mesh to place for them.
+TARGET_POINT_START = """Begin Actor Class=TargetPoint Name=%(label)s Archetype=TargetPoint'/Script/Engine.Default__TargetPoint'
+         Begin Object Class=SceneComponent Name="SceneComp" Archetype=SceneComponent'/Script/Engine.Default__TargetPoint:SceneComp'
          End Object
-         StaticMeshComponent=StaticMeshComponent0
-         RootComponent=StaticMeshComponent0
-         ActorLabel=\"""" + str(record['NAME']) + GRUPS['DOOR'][record['NAME']]['EDID'] + """\"
-      End Actor\n""")
-
-# Furniture
-def writeRecToT3D_FURN(f, record):
-	if 'MODL' in GRUPS['FURN'][record['NAME']]:
-		model = GRUPS['FURN'][record['NAME']]['MODL']
-		path, model = os.path.split(model)
-		model = model.replace('.nif', '').replace('.NIF', '')
-
-		scale = 1.0
-		if 'XSCL' in record:
-			scale = record['XSCL']
-		
-		f.write("""Begin Actor Class=StaticMeshActor Name=""" + str(record['NAME']) + GRUPS['FURN'][record['NAME']]['EDID'] + """ Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
-         Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__StaticMeshActor:StaticMeshComponent0'
+         Begin Object Name="SceneComp"
+            """
+TARGET_POINT_END = """
          End Object
-         Begin Object Name="StaticMeshComponent0"
-            StaticMesh=StaticMesh'/Game/Meshes/""" + path + '/' + model + '.' + model + """'
-            StaticMeshDerivedDataKey="STATICMESH_46A8778361B442A9523C54440EA1E9D_0db5412b27ab480f844cc7f0be5abaff_AF050A664CBE58381B1D05B5C07A33E600000000010000000100000000000000010000004000000000000000010000000000803F0000803F0000803F0000803F000000000000803F00000000000000000000344203030300000000"
-            RelativeLocation=(X=""" + str(record['DATA'][0]) + """,Y=""" + str(record['DATA'][1]) + """,Z=""" + str(record['DATA'][2]) + """)
-            RelativeRotation=(Pitch=""" + str(record['DATA'][3]) + """,Yaw=""" + str(record['DATA'][4]) + """,Roll=""" + str(record['DATA'][5]) + """)
-         	RelativeScale3D=(X=""" + str(scale) + """, Y=""" + str(scale) + """, Z=""" + str(scale) + """)
+         RootComponent=SceneComp
+         ActorLabel="%(label)s"
+      End Actor\n"""
+
+# A PointLight with the radius and color of a light (LIGH), written next
+# to the StaticMeshActor of its model if it has one
+POINT_LIGHT_START = """Begin Actor Class=PointLight Name=%(label)s Archetype=PointLight'/Script/Engine.Default__PointLight'
+         Begin Object Class=PointLightComponent Name="LightComponent0" Archetype=PointLightComponent'/Script/Engine.Default__PointLight:LightComponent0'
          End Object
-         StaticMeshComponent=StaticMeshComponent0
-         RootComponent=StaticMeshComponent0
-         ActorLabel=\"""" + str(record['NAME']) + GRUPS['FURN'][record['NAME']]['EDID'] + """\"
-      End Actor\n""")
-
-# Containers
-def writeRecToT3D_CONT(f, record):
-	if 'MODL' in GRUPS['CONT'][record['NAME']]:
-		model = GRUPS['CONT'][record['NAME']]['MODL']
-		path, model = os.path.split(model)
-		model = model.replace('.nif', '').replace('.NIF', '')
-
-		scale = 1.0
-		if 'XSCL' in record:
-			scale = record['XSCL']
-		
-		f.write("""Begin Actor Class=StaticMeshActor Name=""" + str(record['NAME']) + GRUPS['CONT'][record['NAME']]['EDID'] + """ Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
-         Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__StaticMeshActor:StaticMeshComponent0'
-         End Object
-         Begin Object Name="StaticMeshComponent0"
-            StaticMesh=StaticMesh'/Game/Meshes/""" + path + '/' + model + '.' + model + """'
-            StaticMeshDerivedDataKey="STATICMESH_46A8778361B442A9523C54440EA1E9D_0db5412b27ab480f844cc7f0be5abaff_AF050A664CBE58381B1D05B5C07A33E600000000010000000100000000000000010000004000000000000000010000000000803F0000803F0000803F0000803F000000000000803F00000000000000000000344203030300000000"
-            RelativeLocation=(X=""" + str(record['DATA'][0]) + """,Y=""" + str(record['DATA'][1]) + """,Z=""" + str(record['DATA'][2]) + """)
-            RelativeRotation=(Pitch=""" + str(record['DATA'][3]) + """,Yaw=""" + str(record['DATA'][4]) + """,Roll=""" + str(record['DATA'][5]) + """)
-         	RelativeScale3D=(X=""" + str(scale) + """, Y=""" + str(scale) + """, Z=""" + str(scale) + """)
-         End Object
-         StaticMeshComponent=StaticMeshComponent0
-         RootComponent=StaticMeshComponent0
-         ActorLabel=\"""" + str(record['NAME']) + GRUPS['CONT'][record['NAME']]['EDID'] + """\"
-      End Actor\n""")
-
-# Ammo
-def writeRecToT3D_AMMO(f, record):
-	if 'MODL' in GRUPS['AMMO'][record['NAME']]:
-		model = GRUPS['AMMO'][record['NAME']]['MODL']
-		path, model = os.path.split(model)
-		model = model.replace('.nif', '').replace('.NIF', '')
-
-		scale = 1.0
-		if 'XSCL' in record:
-			scale = record['XSCL']
-		
-		f.write("""Begin Actor Class=StaticMeshActor Name=""" + str(record['NAME']) + GRUPS['AMMO'][record['NAME']]['EDID'] + """ Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
-         Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__StaticMeshActor:StaticMeshComponent0'
-         End Object
-         Begin Object Name="StaticMeshComponent0"
-            StaticMesh=StaticMesh'/Game/Meshes/""" + path + '/' + model + '.' + model + """'
-            StaticMeshDerivedDataKey="STATICMESH_46A8778361B442A9523C54440EA1E9D_0db5412b27ab480f844cc7f0be5abaff_AF050A664CBE58381B1D05B5C07A33E600000000010000000100000000000000010000004000000000000000010000000000803F0000803F0000803F0000803F000000000000803F00000000000000000000344203030300000000"
-            RelativeLocation=(X=""" + str(record['DATA'][0]) + """,Y=""" + str(record['DATA'][1]) + """,Z=""" + str(record['DATA'][2]) + """)
-            RelativeRotation=(Pitch=""" + str(record['DATA'][3]) + """,Yaw=""" + str(record['DATA'][4]) + """,Roll=""" + str(record['DATA'][5]) + """)
-         	RelativeScale3D=(X=""" + str(scale) + """, Y=""" + str(scale) + """, Z=""" + str(scale) + """)
-         End Object
-         StaticMeshComponent=StaticMeshComponent0
-         RootComponent=StaticMeshComponent0
-         ActorLabel=\"""" + str(record['NAME']) + GRUPS['AMMO'][record['NAME']]['EDID'] + """\"
-      End Actor\n""")
-
-# Activator
-def writeRecToT3D_ACTI(f, record):
-	if 'MODL' in GRUPS['ACTI'][record['NAME']]:
-		model = GRUPS['ACTI'][record['NAME']]['MODL']
-		path, model = os.path.split(model)
-		model = model.replace('.nif', '').replace('.NIF', '')
-
-		scale = 1.0
-		if 'XSCL' in record:
-			scale = record['XSCL']
-		
-		f.write("""Begin Actor Class=StaticMeshActor Name=""" + str(record['NAME']) + GRUPS['ACTI'][record['NAME']]['EDID'] + """ Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
-         Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__StaticMeshActor:StaticMeshComponent0'
-         End Object
-         Begin Object Name="StaticMeshComponent0"
-            StaticMesh=StaticMesh'/Game/Meshes/""" + path + '/' + model + '.' + model + """'
-            StaticMeshDerivedDataKey="STATICMESH_46A8778361B442A9523C54440EA1E9D_0db5412b27ab480f844cc7f0be5abaff_AF050A664CBE58381B1D05B5C07A33E600000000010000000100000000000000010000004000000000000000010000000000803F0000803F0000803F0000803F000000000000803F00000000000000000000344203030300000000"
-            RelativeLocation=(X=""" + str(record['DATA'][0]) + """,Y=""" + str(record['DATA'][1]) + """,Z=""" + str(record['DATA'][2]) + """)
-            RelativeRotation=(Pitch=""" + str(record['DATA'][3]) + """,Yaw=""" + str(record['DATA'][4]) + """,Roll=""" + str(record['DATA'][5]) + """)
-         	RelativeScale3D=(X=""" + str(scale) + """, Y=""" + str(scale) + """, Z=""" + str(scale) + """)
-         End Object
-         StaticMeshComponent=StaticMeshComponent0
-         RootComponent=StaticMeshComponent0
-         ActorLabel=\"""" + str(record['NAME']) + GRUPS['ACTI'][record['NAME']]['EDID'] + """\"
-      End Actor\n""")
-
-# ALCH - Alchemy: Medicine, Food, Water, etc..
-def writeRecToT3D_ALCH(f, record):
-	if 'MODL' in GRUPS['ALCH'][record['NAME']]:
-		model = GRUPS['ALCH'][record['NAME']]['MODL']
-		path, model = os.path.split(model)
-		model = model.replace('.nif', '').replace('.NIF', '')
-
-		scale = 1.0
-		if 'XSCL' in record:
-			scale = record['XSCL']
-
-		f.write("""Begin Actor Class=StaticMeshActor Name=""" + str(record['NAME']) + GRUPS['ALCH'][record['NAME']]['EDID'] + """ Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
-         Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__StaticMeshActor:StaticMeshComponent0'
-         End Object
-         Begin Object Name="StaticMeshComponent0"
-            StaticMesh=StaticMesh'/Game/Meshes/""" + path + '/' + model + '.' + model + """'
-            StaticMeshDerivedDataKey="STATICMESH_46A8778361B442A9523C54440EA1E9D_0db5412b27ab480f844cc7f0be5abaff_AF050A664CBE58381B1D05B5C07A33E600000000010000000100000000000000010000004000000000000000010000000000803F0000803F0000803F0000803F000000000000803F00000000000000000000344203030300000000"
-            RelativeLocation=(X=""" + str(record['DATA'][0]) + """,Y=""" + str(record['DATA'][1]) + """,Z=""" + str(record['DATA'][2]) + """)
-            RelativeRotation=(Pitch=""" + str(record['DATA'][3]) + """,Yaw=""" + str(record['DATA'][4]) + """,Roll=""" + str(record['DATA'][5]) + """)
-         	RelativeScale3D=(X=""" + str(scale) + """, Y=""" + str(scale) + """, Z=""" + str(scale) + """)
+         Begin Object Name="LightComponent0"
+            AttenuationRadius=%(radius)s
+            LightColor=(B=%(blue)d,G=%(green)d,R=%(red)d,A=255)
+            """
+POINT_LIGHT_END = """
          End Object
-         StaticMeshComponent=StaticMeshComponent0
-         RootComponent=StaticMeshComponent0
-         ActorLabel=\"""" + str(record['NAME']) + GRUPS['ALCH'][record['NAME']]['EDID'] + """\"
-      End Actor\n""")
-
-# Armor
-def writeRecToT3D_ARMO(f, record):
-	if 'MODL' in GRUPS['ARMO'][record['NAME']]:
-		model = GRUPS['ARMO'][record['NAME']]['MODL']
-		path, model = os.path.split(model)
+         PointLightComponent=LightComponent0
+         LightComponent=LightComponent0
+         RootComponent=LightComponent0
+         ActorLabel="%(label)s"
+      End Actor\n"""
+
+# Number of actors buffered before generateT3D writes them out
+T3D_WRITE_BATCH = 4096
+
+# Batches each background writer thread may have queued up before
+# generateT3D waits for it, and the size of the file buffers they write with
+T3D_WRITE_QUEUE = 16
+T3D_WRITE_BUFFER = 1 << 20
+
+# The T3DWriter generateT3D hands its output to, None to write it itself
+T3D_WRITER = None
+
+# The transform, scale and instance templates with SETTINGS['floatformat']
+# applied, and the RelativeScale3D text of each scale seen so far, built
+# on first use
+TRANSFORM_TEMPLATE = []
+SCALE_TEXT = {}
+
+# Per base record FormID, the (start, end) text of its StaticMeshActor (or
+# TargetPoint for NPCs and creatures) or None if it has nothing to place,
+# and per ('light', FormID) the text of its PointLight. Filled on demand,
+# cleared by buildFormIDIndex.
+ACTOR_FRAGMENTS = {}
+
+# Per model filename (MODL), its Unreal path (see getStaticMeshPath)
+MESH_PATHS = {}
+
+# Per base record FormID, the fingerprint of the parts of it that end up in
+# .T3D files (see fingerprintCell). Cleared by buildFormIDIndex.
+BASE_FINGERPRINTS = {}
+
+# Builds the (start, end) text of the StaticMeshActor for a base record,
+# or returns None if it has no model to place
+def getStaticMeshFragments(formid, base):
+	if 'MODL' not in base:
+		return None
+
+	names = {'label' : str(formid) + base['EDID'], 'mesh' : getStaticMeshPath(base)}
+
+	return STATIC_MESH_ACTOR_START % names, STATIC_MESH_ACTOR_END % names
+
+# Builds the (start, end) text of the TargetPoint marking an NPC or creature
+def getTargetPointFragments(formid, base):
+	names = {'label' : str(formid) + base.get('EDID', '')}
+
+	return TARGET_POINT_START % names, TARGET_POINT_END % names
+
+# Builds the (start, end) text of the PointLight of a light, or returns
+# None if it has no light data
+def getPointLightFragments(formid, base):
+	if 'DATA' not in base:
+		return None
+
+	red, green, blue = base['DATA']['Color']
+	names = {'label' : str(formid) + base.get('EDID', '') + 'Light', 'radius' : str(base['DATA']['Radius'] * SETTINGS['scale']), 'red' : red, 'green' : green, 'blue' : blue}
+
+	return POINT_LIGHT_START % names, POINT_LIGHT_END % names
+
+# Returns the Unreal path of the model of a base record, relative to
+# /Game/Meshes. Resolved once per model file and shared by every record
+# using it.
+def getStaticMeshPath(base):
+	mesh = MESH_PATHS.get(base['MODL'])
+	if mesh is None:
+		path, model = os.path.split(base['MODL'])
 		model = model.replace('.nif', '').replace('.NIF', '')
+		mesh = MESH_PATHS[base['MODL']] = sys.intern(path + '/' + model + '.' + model)
 
-		scale = 1.0
-		if 'XSCL' in record:
-			scale = record['XSCL']
+	return mesh
 
-		f.write("""Begin Actor Class=StaticMeshActor Name=""" + str(record['NAME']) + GRUPS['ARMO'][record['NAME']]['EDID'] + """ Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
-         Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__StaticMeshActor:StaticMeshComponent0'
-         End Object
-         Begin Object Name="StaticMeshComponent0"
-            StaticMesh=StaticMesh'/Game/Meshes/""" + path + '/' + model + '.' + model + """'
-            StaticMeshDerivedDataKey="STATICMESH_46A8778361B442A9523C54440EA1E9D_0db5412b27ab480f844cc7f0be5abaff_AF050A664CBE58381B1D05B5C07A33E600000000010000000100000000000000010000004000000000000000010000000000803F0000803F0000803F0000803F000000000000803F00000000000000000000344203030300000000"
-            RelativeLocation=(X=""" + str(record['DATA'][0]) + """,Y=""" + str(record['DATA'][1]) + """,Z=""" + str(record['DATA'][2]) + """)
-            RelativeRotation=(Pitch=""" + str(record['DATA'][3]) + """,Yaw=""" + str(record['DATA'][4]) + """,Roll=""" + str(record['DATA'][5]) + """)
-         	RelativeScale3D=(X=""" + str(scale) + """, Y=""" + str(scale) + """, Z=""" + str(scale) + """)
-         End Object
-         StaticMeshComponent=StaticMeshComponent0
-         RootComponent=StaticMeshComponent0
-         ActorLabel=\"""" + str(record['NAME']) + GRUPS['ARMO'][record['NAME']]['EDID'] + """\"
-      End Actor\n""")
-
-# Books
-def writeRecToT3D_BOOK(f, record):
-	if 'MODL' in GRUPS['BOOK'][record['NAME']]:
-		model = GRUPS['BOOK'][record['NAME']]['MODL']
-		path, model = os.path.split(model)
-		model = model.replace('.nif', '').replace('.NIF', '')
+# Generates a single .T3D file given a cell and
+# an optional output directory for the .T3D file
+# (The output directory is intended mostly for debug use)
+def generateT3D(cell, directory=''):
+	# Actors are collected and written out in large batches rather than
+	# with one write each. The file is written under a temporary name and
+	# swapped in at the end, so a half written map never replaces a good one.
+	# With -writers all of that is left to the background writer threads.
+	name = getCellName(cell)
+	path = directory + name + '.t3d'
+	writer = T3D_WRITER
+	if writer is not None:
+		write = lambda data: writer.write(path, data)
+	else:
+		if directory != '' and not os.path.exists(directory):
+			os.makedirs(directory, exist_ok=True) # Another worker may beat us to it
 
-		scale = 1.0
-		if 'XSCL' in record:
-			scale = record['XSCL']
+		f = open(path + '.tmp', 'w+')
+		write = f.write
 
-		f.write("""Begin Actor Class=StaticMeshActor Name=""" + str(record['NAME']) + GRUPS['BOOK'][record['NAME']]['EDID'] + """ Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
-         Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__StaticMeshActor:StaticMeshComponent0'
-         End Object
-         Begin Object Name="StaticMeshComponent0"
-            StaticMesh=StaticMesh'/Game/Meshes/""" + path + '/' + model + '.' + model + """'
-            StaticMeshDerivedDataKey="STATICMESH_46A8778361B442A9523C54440EA1E9D_0db5412b27ab480f844cc7f0be5abaff_AF050A664CBE58381B1D05B5C07A33E600000000010000000100000000000000010000004000000000000000010000000000803F0000803F0000803F0000803F000000000000803F00000000000000000000344203030300000000"
-            RelativeLocation=(X=""" + str(record['DATA'][0]) + """,Y=""" + str(record['DATA'][1]) + """,Z=""" + str(record['DATA'][2]) + """)
-            RelativeRotation=(Pitch=""" + str(record['DATA'][3]) + """,Yaw=""" + str(record['DATA'][4]) + """,Roll=""" + str(record['DATA'][5]) + """)
-         	RelativeScale3D=(X=""" + str(scale) + """, Y=""" + str(scale) + """, Z=""" + str(scale) + """)
-         End Object
-         StaticMeshComponent=StaticMeshComponent0
-         RootComponent=StaticMeshComponent0
-         ActorLabel=\"""" + str(record['NAME']) + GRUPS['BOOK'][record['NAME']]['EDID'] + """\"
-      End Actor\n""")
-
-# Keys
-def writeRecToT3D_KEYM(f, record):
-	if 'MODL' in GRUPS['KEYM'][record['NAME']]:
-		model = GRUPS['KEYM'][record['NAME']]['MODL']
-		path, model = os.path.split(model)
-		model = model.replace('.nif', '').replace('.NIF', '')
+	parts = ['Begin Map Name=/Game/Maps/' + name + '\n' + T3D_HEADER]
 
-		scale = 1.0
-		if 'XSCL' in record:
-			scale = record['XSCL']
+	# Loop through children of the cell and write in the
+	# appropriate UE4 actor data to the map
+	if 'Children' in cell:
+		zones = cell['Children'].values()
+		if SETTINGS['instance'] > 0:
+			zones = [writeInstancedMeshActors(parts, zones)]
 
-		f.write("""Begin Actor Class=StaticMeshActor Name=""" + str(record['NAME']) + GRUPS['KEYM'][record['NAME']]['EDID'] + """ Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
-         Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__StaticMeshActor:StaticMeshComponent0'
-         End Object
-         Begin Object Name="StaticMeshComponent0"
-            StaticMesh=StaticMesh'/Game/Meshes/""" + path + '/' + model + '.' + model + """'
-            StaticMeshDerivedDataKey="STATICMESH_46A8778361B442A9523C54440EA1E9D_0db5412b27ab480f844cc7f0be5abaff_AF050A664CBE58381B1D05B5C07A33E600000000010000000100000000000000010000004000000000000000010000000000803F0000803F0000803F0000803F000000000000803F00000000000000000000344203030300000000"
-            RelativeLocation=(X=""" + str(record['DATA'][0]) + """,Y=""" + str(record['DATA'][1]) + """,Z=""" + str(record['DATA'][2]) + """)
-            RelativeRotation=(Pitch=""" + str(record['DATA'][3]) + """,Yaw=""" + str(record['DATA'][4]) + """,Roll=""" + str(record['DATA'][5]) + """)
-         	RelativeScale3D=(X=""" + str(scale) + """, Y=""" + str(scale) + """, Z=""" + str(scale) + """)
-         End Object
-         StaticMeshComponent=StaticMeshComponent0
-         RootComponent=StaticMeshComponent0
-         ActorLabel=\"""" + str(record['NAME']) + GRUPS['KEYM'][record['NAME']]['EDID'] + """\"
-      End Actor\n""")
-
-# Misc. Items
-def writeRecToT3D_MISC(f, record):
-	if 'MODL' in GRUPS['MISC'][record['NAME']]:
-		model = GRUPS['MISC'][record['NAME']]['MODL']
-		path, model = os.path.split(model)
-		model = model.replace('.nif', '').replace('.NIF', '')
+		for zone in zones:
+			for child in zone:
+				entry = FORMIDS.get(child['NAME']) # (record type, base record, writer)
+				if entry is not None and entry[2] is not None and 'DATA' in child:
+					entry[2](parts, child, entry[1])
 
-		scale = 1.0
-		if 'XSCL' in record:
-			scale = record['XSCL']
+				if len(parts) >= T3D_WRITE_BATCH:
+					write(''.join(parts))
+					del parts[:]
 
-		f.write("""Begin Actor Class=StaticMeshActor Name=""" + str(record['NAME']) + GRUPS['MISC'][record['NAME']]['EDID'] + """ Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
-         Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__StaticMeshActor:StaticMeshComponent0'
-         End Object
-         Begin Object Name="StaticMeshComponent0"
-            StaticMesh=StaticMesh'/Game/Meshes/""" + path + '/' + model + '.' + model + """'
-            StaticMeshDerivedDataKey="STATICMESH_46A8778361B442A9523C54440EA1E9D_0db5412b27ab480f844cc7f0be5abaff_AF050A664CBE58381B1D05B5C07A33E600000000010000000100000000000000010000004000000000000000010000000000803F0000803F0000803F0000803F000000000000803F00000000000000000000344203030300000000"
-            RelativeLocation=(X=""" + str(record['DATA'][0]) + """,Y=""" + str(record['DATA'][1]) + """,Z=""" + str(record['DATA'][2]) + """)
-            RelativeRotation=(Pitch=""" + str(record['DATA'][3]) + """,Yaw=""" + str(record['DATA'][4]) + """,Roll=""" + str(record['DATA'][5]) + """)
-         	RelativeScale3D=(X=""" + str(scale) + """, Y=""" + str(scale) + """, Z=""" + str(scale) + """)
-         End Object
-         StaticMeshComponent=StaticMeshComponent0
-         RootComponent=StaticMeshComponent0
-         ActorLabel=\"""" + str(record['NAME']) + GRUPS['MISC'][record['NAME']]['EDID'] + """\"
-      End Actor\n""")
-
-# Weapons
-def writeRecToT3D_WEAP(f, record):
-	if 'MODL' in GRUPS['WEAP'][record['NAME']]:
-		model = GRUPS['WEAP'][record['NAME']]['MODL']
-		path, model = os.path.split(model)
-		model = model.replace('.nif', '').replace('.NIF', '')
+	# Wrap up the .T3D file
+	parts.append(T3D_FOOTER)
+	write(''.join(parts))
+	if writer is not None:
+		writer.finish(path)
+	else:
+		f.close()
+		os.replace(path + '.tmp', path)
+
+# Writes .T3D files on background threads, so generating the next batch of
+# actors overlaps with writing the last one out. Files are spread over the
+# threads by path and each thread has a bounded queue, so generateT3D only
+# waits when it gets ahead of the disk by T3D_WRITE_QUEUE batches. Threads
+# create every directory once, write through large buffers and swap each
+# file in from its temporary name when it is finished, like generateT3D.
+class T3DWriter(object):
+	def __init__(self, threads):
+		self.queues = [queue.Queue(T3D_WRITE_QUEUE) for i in range(threads)]
+		self.threads = [threading.Thread(target=self.run, args=(q,), daemon=True) for q in self.queues]
+		self.error = None
+		for thread in self.threads:
+			thread.start()
+
+	# Queues text to be appended to the file at path
+	def write(self, path, data):
+		if self.error is not None:
+			raise self.error
+		self.queues[hash(path) % len(self.queues)].put((path, data, False))
+
+	# Queues the file at path to be closed and swapped in
+	def finish(self, path):
+		self.queues[hash(path) % len(self.queues)].put((path, None, True))
+
+	# Waits for every queued write, raising the first error of any thread
+	def close(self):
+		for q in self.queues:
+			q.put(None)
+		for thread in self.threads:
+			thread.join()
+
+		if self.error is not None:
+			raise self.error
+
+	def run(self, q):
+		files = {}
+		directories = set()
+		while True:
+			item = q.get()
+			if item is None:
+				break
 
-		scale = 1.0
-		if 'XSCL' in record:
-			scale = record['XSCL']
+			path, data, final = item
+			if self.error is not None:
+				continue # Keep draining the queue so nothing waits on it
+
+			try:
+				f = files.get(path)
+				if f is None:
+					directory = os.path.dirname(path)
+					if directory and directory not in directories:
+						os.makedirs(directory, exist_ok=True)
+						directories.add(directory)
+					f = files[path] = open(path + '.tmp', 'w+', buffering=T3D_WRITE_BUFFER)
+
+				if data:
+					f.write(data)
+				if final:
+					del files[path]
+					f.close()
+					os.replace(path + '.tmp', path)
+			except Exception as e:
+				self.error = e
+
+		for f in files.values():
+			f.close()
 
-		f.write("""Begin Actor Class=StaticMeshActor Name=""" + str(record['NAME']) + GRUPS['WEAP'][record['NAME']]['EDID'] + """ Archetype=StaticMeshActor'/Script/Engine.Default__StaticMeshActor'
-         Begin Object Class=StaticMeshComponent Name="StaticMeshComponent0" Archetype=StaticMeshComponent'/Script/Engine.Default__StaticMeshActor:StaticMeshComponent0'
-         End Object
-         Begin Object Name="StaticMeshComponent0"
-            StaticMesh=StaticMesh'/Game/Meshes/""" + path + '/' + model + '.' + model + """'
-            StaticMeshDerivedDataKey="STATICMESH_46A8778361B442A9523C54440EA1E9D_0db5412b27ab480f844cc7f0be5abaff_AF050A664CBE58381B1D05B5C07A33E600000000010000000100000000000000010000004000000000000000010000000000803F0000803F0000803F0000803F000000000000803F00000000000000000000344203030300000000"
-            RelativeLocation=(X=""" + str(record['DATA'][0]) + """,Y=""" + str(record['DATA'][1]) + """,Z=""" + str(record['DATA'][2]) + """)
-            RelativeRotation=(Pitch=""" + str(record['DATA'][3]) + """,Yaw=""" + str(record['DATA'][4]) + """,Roll=""" + str(record['DATA'][5]) + """)
-         	RelativeScale3D=(X=""" + str(scale) + """, Y=""" + str(scale) + """, Z=""" + str(scale) + """)
-         End Object
-         StaticMeshComponent=StaticMeshComponent0
-         RootComponent=StaticMeshComponent0
-         ActorLabel=\"""" + str(record['NAME']) + GRUPS['WEAP'][record['NAME']]['EDID'] + """\"
-      End Actor\n""")
+# Hands the output of generateT3D to a T3DWriter with SETTINGS['writers']
+# threads for the duration of a with block, waiting for it to finish
+# writing at the end. Does nothing without -writers or if one is in use.
+@contextlib.contextmanager
+def backgroundT3DWriter():
+	global T3D_WRITER
+	if SETTINGS['writers'] < 1 or T3D_WRITER is not None:
+		yield
+		return
+
+	T3D_WRITER = T3DWriter(SETTINGS['writers'])
+	try:
+		yield
+	finally:
+		writer, T3D_WRITER = T3D_WRITER, None
+		writer.close()
+
+# Returns the fragments of an actor cached in ACTOR_FRAGMENTS under key,
+# building them with getFragments(formid, base) the first time around
+def getActorFragments(key, getFragments, formid, base):
+	fragments = ACTOR_FRAGMENTS.get(key, False)
+	if fragments is False:
+		if RECORD_STORE is not None and len(ACTOR_FRAGMENTS) >= RECORD_STORE.getFragmentLimit():
+			ACTOR_FRAGMENTS.clear() # Their text would otherwise outgrow the records held decoded
+		fragments = ACTOR_FRAGMENTS[key] = getFragments(formid, base)
+
+	return fragments
+
+# Writes a reference to a base record with a model as a StaticMeshActor,
+# appending its text to parts
+def writeStaticMeshActor(parts, record, base):
+	fragments = getActorFragments(record['NAME'], getStaticMeshFragments, record['NAME'], base)
+	if fragments is not None:
+		writeActorTransform(parts, record, fragments)
+
+# Writes a placed NPC or creature (ACHR/ACRE) as a TargetPoint, appending
+# its text to parts
+def writeActorMarker(parts, record, base):
+	writeActorTransform(parts, record, getActorFragments(record['NAME'], getTargetPointFragments, record['NAME'], base))
+
+# Writes a reference to a light as a PointLight, after the StaticMeshActor
+# of its model if it has one, appending their text to parts
+def writeLight(parts, record, base):
+	writeStaticMeshActor(parts, record, base)
+
+	fragments = getActorFragments(('light', record['NAME']), getPointLightFragments, record['NAME'], base)
+	if fragments is not None:
+		writeActorTransform(parts, record, fragments)
+
+# Appends the text of an actor to parts: its (start, end) fragments with
+# the transform of the reference in between
+def writeActorTransform(parts, record, fragments):
+	if not TRANSFORM_TEMPLATE:
+		getTransformTemplate()
+
+	scale = record.get('XSCL', 1.0)
+	scaleText = SCALE_TEXT.get(scale)
+	if scaleText is None:
+		scaleText = SCALE_TEXT[scale] = TRANSFORM_TEMPLATE[1].format(scale)
+
+	parts.append(fragments[0] + TRANSFORM_TEMPLATE[0].format(*record['DATA']) + scaleText + fragments[1])
+
+# Groups the references of a cell (given its zones) that would be written
+# as StaticMeshActors by their mesh, and writes every mesh placed at least
+# SETTINGS['instance'] times as a single instanced mesh actor, appending
+# its text to parts. Returns the references still to be written one by one.
+def writeInstancedMeshActors(parts, zones):
+	remaining = []
+	meshes = {} # Mesh path: references placing it
+	bases = {} # Base record FormID: mesh path, or None if not instanced
+	for zone in zones:
+		for child in zone:
+			formid = child.get('NAME')
+			mesh = bases.get(formid, False)
+			if mesh is False:
+				entry = FORMIDS.get(formid)
+				mesh = None
+				if entry is not None and entry[2] is writeStaticMeshActor and 'MODL' in entry[1]:
+					mesh = getStaticMeshPath(entry[1])
+				bases[formid] = mesh
+
+			if mesh is None or 'DATA' not in child:
+				remaining.append(child)
+			else:
+				meshes.setdefault(mesh, []).append(child)
+
+	if not TRANSFORM_TEMPLATE:
+		getTransformTemplate()
+
+	number = 0
+	for mesh, refs in meshes.items():
+		if len(refs) < SETTINGS['instance']:
+			remaining.extend(refs)
+			continue
+
+		number += 1
+		model = mesh.rsplit('.', 1)[-1]
+		names = {'label' : 'Instances' + str(number) + '_' + model, 'mesh' : mesh}
+		instances = [INSTANCED_MESH_ACTOR_START % names]
+		for i, ref in enumerate(refs):
+			instances.append(TRANSFORM_TEMPLATE[2].format(i, *getInstanceMatrix(ref['DATA'], ref.get('XSCL', 1.0))))
+		instances.append(INSTANCED_MESH_ACTOR_END % names)
+		parts.append(''.join(instances))
+
+	return remaining
+
+# Returns the 3x4 transform matrix (its X, Y, Z and W rows) of a reference,
+# the way Unreal builds it from the RelativeLocation, RelativeRotation (in
+# degrees) and RelativeScale3D writeStaticMeshActor would have written
+def getInstanceMatrix(data, scale):
+	x, y, z, pitch, yaw, roll = data
+	sp, cp = math.sin(math.radians(pitch)), math.cos(math.radians(pitch))
+	sy, cy = math.sin(math.radians(yaw)), math.cos(math.radians(yaw))
+	sr, cr = math.sin(math.radians(roll)), math.cos(math.radians(roll))
+
+	return (
+		cp * cy * scale, cp * sy * scale, sp * scale,
+		(sr * sp * cy - cr * sy) * scale, (sr * sp * sy + cr * cy) * scale, -sr * cp * scale,
+		-(cr * sp * cy + sr * sy) * scale, (cy * sr - cr * sp * sy) * scale, cr * cp * scale,
+		x, y, z,
+	)
+
+# Applies SETTINGS['floatformat'] to the transform templates, clearing
+# the scale text formatted with the previous one
+def getTransformTemplate():
+	transform, scale, instance = STATIC_MESH_ACTOR_TRANSFORM, STATIC_MESH_ACTOR_SCALE, INSTANCED_MESH_ACTOR_INSTANCE
+	if SETTINGS['floatformat'] is not None:
+		for i in range(6):
+			transform = transform.replace('{%d}' % i, '{%d:%s}' % (i, SETTINGS['floatformat']))
+		scale = scale.replace('{0}', '{0:%s}' % SETTINGS['floatformat'])
+		for i in range(1, 13):
+			instance = instance.replace('{%d}' % i, '{%d:%s}' % (i, SETTINGS['floatformat']))
+
+	TRANSFORM_TEMPLATE[:] = [transform, scale, instance]
+	SCALE_TEXT.clear()
 
 # Dict to help organize T3D output functions
 # by the type of object/record being written
 writeRecToT3DFuncs = {
-	'STAT' : writeRecToT3D_STAT,
-	'DOOR' : writeRecToT3D_DOOR,
-	'FURN' : writeRecToT3D_FURN,
-	'CONT' : writeRecToT3D_CONT,
-	'AMMO' : writeRecToT3D_AMMO,
-	'ACTI' : writeRecToT3D_ACTI,
-	'ALCH' : writeRecToT3D_ALCH,
-	'ARMO' : writeRecToT3D_ARMO,
-	'BOOK' : writeRecToT3D_BOOK,
-	'KEYM' : writeRecToT3D_KEYM,
-	'MISC' : writeRecToT3D_MISC,
-	'WEAP' : writeRecToT3D_WEAP,
+	'STAT' : writeStaticMeshActor, # Static Meshes
+	'DOOR' : writeStaticMeshActor, # Doors
+	'FURN' : writeStaticMeshActor, # Furniture
+	'CONT' : writeStaticMeshActor, # Containers
+	'AMMO' : writeStaticMeshActor, # Ammo
+	'ACTI' : writeStaticMeshActor, # Activators
+	'ALCH' : writeStaticMeshActor, # Alchemy: Medicine, Food, Water, etc..
+	'ARMO' : writeStaticMeshActor, # Armor
+	'BOOK' : writeStaticMeshActor, # Books
+	'KEYM' : writeStaticMeshActor, # Keys
+	'MISC' : writeStaticMeshActor, # Misc. Items
+	'WEAP' : writeStaticMeshActor, # Weapons
+	'LIGH' : writeLight, # Lights
+	'NPC_' : writeActorMarker, # NPCs
+	'CREA' : writeActorMarker, # Creatures
 }
 
-if len(sys.argv) > 2:
-	for arg in sys.argv[2:]:
-		if arg == '-dumpgroups':
+# Module globals holding the state of a parse. ESMFile keeps its own set
+# and swaps it in around every call into the module, so any number of
+# files can be loaded in one process and reused.
+STATE_NAMES = ('SETTINGS', 'GRUPS', 'FORMIDS', 'EDIDS', 'ACTOR_FRAGMENTS', 'BASE_FINGERPRINTS', 'TRANSFORM_TEMPLATE', 'SCALE_TEXT', 'placementTable', 'RECORD_STORE')
+
+# Held while an ESMFile's state is swapped in, as there is only one set of globals
+STATE_LOCK = threading.RLock()
+
+# A parsed .ESM (or load order of plugins) that owns its records, cells and
+# settings instead of leaving them in the module globals, for use as a
+# library. Settings start from the module's SETTINGS with any given as
+# keyword arguments applied, e.g. ESMFile('Fallout3.esm', lazy=True).
+# Iterating walks the file's own state without swapping it in, so any
+# number of iterators over any number of files can be open at once.
+class ESMFile(object):
+	def __init__(self, filepaths, pluginCellsOnly=False, **settings):
+		if isinstance(filepaths, str):
+			filepaths = [filepaths]
+
+		self.filepaths = list(filepaths)
+		self.plugins = None # The plugins of a load order, see openPlugin
+		self.state = {
+			'SETTINGS' : dict(copy.deepcopy(SETTINGS), **settings),
+			'GRUPS' : {rtype : ({'interior' : {}, 'exterior' : {}} if rtype == 'CELL' else {}) for rtype in GRUPS},
+			'FORMIDS' : {},
+			'EDIDS' : {},
+			'ACTOR_FRAGMENTS' : {},
+			'BASE_FINGERPRINTS' : {},
+			'TRANSFORM_TEMPLATE' : [],
+			'SCALE_TEXT' : {},
+			'placementTable' : None,
+			'RECORD_STORE' : None,
+		}
+
+		with self.activate():
+			if len(self.filepaths) == 1:
+				loadESM(self.filepaths[0])
+			else:
+				self.plugins = loadPlugins(self.filepaths, pluginCellsOnly)
+				if self.plugins is None:
+					raise ValueError('Could not load ' + ', '.join(self.filepaths))
+
+	# Swaps this file's state into the module globals for the duration of
+	# a with block, so module functions can be called on it directly. The
+	# block must not yield, or STATE_LOCK would be held in between. State
+	# the module rebinds while it runs (a new placement table or record
+	# store) is kept if the block completes.
+	@contextlib.contextmanager
+	def activate(self):
+		with STATE_LOCK:
+			module = globals()
+			saved = {name : module[name] for name in STATE_NAMES}
+			module.update(self.state)
+			try:
+				yield self
+				for name in STATE_NAMES:
+					if module[name] is not self.state[name]:
+						self.state[name] = module[name]
+			finally:
+				module.update(saved)
+
+	@property
+	def settings(self):
+		return self.state['SETTINGS']
+
+	# Yields a (FormID, record type, record) tuple for every base record and
+	# worldspace, or only those of record type rtype if given
+	def records(self, rtype=None):
+		for groupType, group in self.state['GRUPS'].items():
+			if groupType != 'CELL' and rtype in (None, groupType):
+				for formid, record in group.items():
+					yield formid, groupType, record
+
+	# Yields every cell along with the FormID of its worldspace (see iterCells)
+	def cells(self):
+		return iterCells(self.state['GRUPS'])
+
+	# Yields a (cell, zone name, reference) tuple for every reference (see iterReferences)
+	def references(self):
+		return iterReferences(self.state['GRUPS'])
+
+	# Returns the record with the given FormID, or None if there is none
+	def lookupFormID(self, formid):
+		with self.activate():
+			return lookupFormID(formid)
+
+	# Returns the FormID of the record with the given Editor ID, or None
+	def lookupEDID(self, edid):
+		with self.activate():
+			return lookupEDID(edid)
+
+	# Writes the .T3D files of the cells (only those matching patterns if
+	# given, see -cell) to cells/ in the current directory
+	def generateCellManifests(self, patterns=None):
+		with self.activate():
+			cells = SETTINGS['cells']
+			SETTINGS['cells'] = list(patterns or [])
+			try:
+				generateCellManifests()
+			finally:
+				SETTINGS['cells'] = cells
+
+	# Dumps the top groups to topgroups/ in the current directory (see -dumpgroups)
+	def writeObjectsToFile(self):
+		with self.activate():
+			writeObjectsToFile()
+
+	# Writes everything parsed to an SQLite database at path (see -sqlite)
+	def writeObjectsToSQLite(self, path):
+		with self.activate():
+			writeObjectsToSQLite(path)
+
+# File extensions of the plugins picked up from directories in batch mode
+PLUGIN_EXTENSIONS = ('.esm', '.esp')
+
+# Plans a batch conversion (see -batch) of the given plugins and directories
+# of plugins. Returns a list of (plugin, load order, error) tuples, largest
+# plugin first so the long jobs start early, and the masters any of them
+# need. Masters are looked for among the given plugins first, then next to
+# the plugin needing them. A plugin whose header can't be read or whose
+# masters can't be found gets no load order, but an error instead.
+def planBatch(paths):
+	filepaths = []
+	for path in paths:
+		if os.path.isdir(path):
+			filepaths.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(PLUGIN_EXTENSIONS)))
+		else:
+			filepaths.append(path)
+
+	known = {os.path.basename(filepath).lower() : os.path.abspath(filepath) for filepath in filepaths}
+	jobs = []
+	masters = set()
+	for filepath in sorted(filepaths, key=os.path.getsize, reverse=True):
+		try:
+			with mappedESM(filepath) as buf:
+				names = readMastersBuf(buf)
+		except (OSError, ValueError, struct.error) as e:
+			jobs.append((filepath, None, 'Unable to read the header: ' + str(e)))
+			continue
+
+		order = []
+		for master in names:
+			masterPath = known.get(master.lower(), os.path.join(os.path.dirname(os.path.abspath(filepath)), master))
+			if not os.path.isfile(masterPath):
+				jobs.append((filepath, None, 'Master ' + master + ' not found'))
+				break
+			order.append(masterPath)
+		else:
+			masters.update(order)
+			jobs.append((filepath, order + [os.path.abspath(filepath)], None))
+
+	return jobs, sorted(masters)
+
+# Base records of the masters of a batch, decoded once by runBatch before
+# its worker processes are forked from it so every job can share them. Per
+# master path, the record at each offset, with the master's own FormIDs.
+MASTER_RECORDS = {}
+
+# Decodes every record of the supported base record top groups of a master
+# (not worldspaces, which get their persistent cell attached), by offset
+def decodeMasterRecords(filepath):
+	records = {}
+	with mappedESM(filepath) as buf:
+		for entry in openIndex(filepath, buf)['entries']:
+			if entry.groupType == 0 and entry.type in GRUPS and entry.type not in ('CELL', 'WRLD') and entry.label == entry.type.encode():
+				records[entry.offset] = decodeRecordBuf(buf, entry.offset, entry.type)
+
+	return records
+
+# Process pool task of runBatch. Converts one plugin given its load order
+# (its masters, then the plugin) into the directory root, logging to
+# root/log.txt. Only the cells the plugin adds or changes are written, the
+# records of its masters are only there for it to use. Returns a summary
+# of the job.
+def runBatchJob(filepath, order, root, settings):
+	start = time.perf_counter()
+	result = {'plugin' : filepath, 'output' : root, 'masters' : order[:-1], 'error' : None}
+	cwd = os.getcwd()
+	try:
+		os.makedirs(root, exist_ok=True)
+		os.chdir(root)
+		log = open('log.txt', 'w')
+		try:
+			with contextlib.redirect_stdout(log):
+				esm = ESMFile(order, pluginCellsOnly=True, **settings)
+				with esm.activate():
+					if SETTINGS['dumpgroups']:
+						writeObjectsToFile()
+					if SETTINGS['sqlite']:
+						writeObjectsToSQLite(SETTINGS['sqlite'])
+					if not SETTINGS['nomanifests']:
+						generateCellManifests()
+					result['cells'] = sum(1 for cell in iterCellManifests())
+		finally:
+			log.close()
+	except Exception as e:
+		result['error'] = type(e).__name__ + ': ' + str(e)
+	finally:
+		os.chdir(cwd)
+
+	result['seconds'] = time.perf_counter() - start
+	return result
+
+# Converts every given plugin (or plugin in the given directories) on its
+# own, each into a directory of the same name under outputRoot, on a pool
+# of SETTINGS['jobs'] processes (one per CPU if 0 or not set). Plugins that need
+# masters are loaded along with them as a load order, but only the cells
+# of the plugin itself are parsed. The offset index and base records of
+# every master are built and decoded once up front, before the workers are
+# forked, so jobs sharing a master reuse them instead of each parsing the
+# master again. Prints a summary and saves it as outputRoot/summary.json.
+# Returns the number of plugins that failed.
+def runBatch(paths, outputRoot):
+	start = time.perf_counter()
+	jobs, masters = planBatch(paths)
+	print('Converting ' + str(len(jobs)) + ' plugins into ' + outputRoot + '..')
+
+	for master in masters:
+		if usesRecordStore(): # Records are left to each job's RecordStore
+			with mappedESM(master) as buf:
+				openIndex(master, buf)
+		else:
+			print('Decoding master ' + master + '..')
+			MASTER_RECORDS[master] = decodeMasterRecords(master)
+
+	settings = dict(SETTINGS, jobs=1, batch=None, profile=None, cprofile=None, tracemalloc=False)
+	workers = SETTINGS['jobs'] or None # None for one per CPU, when -jobs is 0 or not given
+	context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None # Elsewhere jobs decode the masters themselves
+	results = []
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+		futures = []
+		for filepath, order, error in jobs:
+			root = os.path.abspath(os.path.join(outputRoot, os.path.splitext(os.path.basename(filepath))[0]))
+			if order is None:
+				results.append({'plugin' : filepath, 'output' : root, 'error' : error, 'seconds' : 0.0})
+			else:
+				futures.append(pool.submit(runBatchJob, filepath, order, root, settings))
+
+		for future in concurrent.futures.as_completed(futures):
+			result = future.result()
+			results.append(result)
+			print(('Failed ' if result['error'] else 'Converted ') + result['plugin'] + ' in ' + '%.1f' % result['seconds'] + 's (' + str(len(results)) + '/' + str(len(jobs)) + ')')
+
+	failed = [result for result in results if result['error']]
+	summary = {'wall' : time.perf_counter() - start, 'plugins' : sorted(results, key=lambda result: result['plugin']), 'failed' : len(failed)}
+	os.makedirs(outputRoot, exist_ok=True)
+	f = open(os.path.join(outputRoot, 'summary.json'), 'w')
+	try:
+		json.dump(summary, f, indent=1)
+	finally:
+		f.close()
+
+	print('Converted ' + str(len(results) - len(failed)) + ' of ' + str(len(results)) + ' plugins in ' + '%.1f' % summary['wall'] + 's.')
+	for result in failed:
+		print('   ' + result['plugin'] + ': ' + result['error'])
+
+	return len(failed)
+
+# Runs the command line interface on argv (sys.argv[1:] if None)
+def main(argv=None):
+	args = iter(sys.argv[1:] if argv is None else argv)
+	plugins = []
+	for arg in args:
+		if not arg.startswith('-'): # Plugins, in load order
+			plugins.append(arg)
+		elif arg == '-dumpgroups':
 			SETTINGS['dumpgroups'] = True
 		elif arg == '-nomanifests':
 			SETTINGS['nomanifests'] = True
 		elif arg == '-allsubs':
 			SETTINGS['allsubs'] = True
-
-if len(sys.argv) > 1 and os.path.isfile(sys.argv[1]):
-	# Parse the .ESM and populate our GRUPS dict
-	# with all of the information from relevant and
-	# parsable top groups
-	parseESM(str(sys.argv[1]))
-
-	# Dump top group data to file
-	if SETTINGS['dumpgroups']:
-		writeObjectsToFile()
-
-	# Generate cell manifests as .T3D files
-	if not SETTINGS['nomanifests']:	
-		generateCellManifests()
-else:
-	print('Please specify a path to a valid .ESM file.')
+		elif arg == '-nommap':
+			SETTINGS['mmap'] = False
+		elif arg == '-index':
+			SETTINGS['index'] = True
+		elif arg == '-cache':
+			SETTINGS['cache'] = True
+		elif arg == '-rebuildcache':
+			SETTINGS['rebuildcache'] = True
+		elif arg == '-jobs':
+			SETTINGS['jobs'] = int(next(args, '0'))
+		elif arg == '-lazy':
+			SETTINGS['lazy'] = True
+		elif arg == '-columnar':
+			SETTINGS['columnar'] = True
+		elif arg == '-floatformat':
+			SETTINGS['floatformat'] = next(args, None)
+		elif arg == '-incremental':
+			SETTINGS['incremental'] = True
+		elif arg == '-stream':
+			SETTINGS['stream'] = True
+		elif arg == '-cell':
+			SETTINGS['cells'].append(next(args, ''))
+		elif arg == '-profile':
+			SETTINGS['profile'] = next(args, 'profile.json')
+		elif arg == '-cprofile':
+			SETTINGS['cprofile'] = next(args, 'profile.prof')
+		elif arg == '-tracemalloc':
+			SETTINGS['tracemalloc'] = True
+		elif arg == '-sqlite':
+			SETTINGS['sqlite'] = next(args, 'esm.sqlite')
+		elif arg == '-batch':
+			SETTINGS['batch'] = next(args, 'batch')
+		elif arg == '-recordcache':
+			SETTINGS['recordcache'] = max(1, int(next(args, '10000')))
+		elif arg == '-recordcachemb':
+			SETTINGS['recordcachemb'] = float(next(args, '256'))
+		elif arg == '-writers':
+			SETTINGS['writers'] = max(1, int(next(args, '1')))
+		elif arg == '-instance':
+			SETTINGS['instance'] = max(1, int(next(args, '2')))
+		elif arg == '-tile':
+			SETTINGS['tile'] = max(1, int(next(args, '1')))
+
+	if SETTINGS['profile']:
+		startProfile()
+
+	if SETTINGS['batch'] and plugins and all(os.path.exists(plugin) for plugin in plugins):
+		# Convert every plugin on its own, on a pool of processes
+		with profileSection('phases', 'batch'):
+			failed = runBatch(plugins, SETTINGS['batch'])
+		if failed:
+			sys.exit(1)
+	elif not plugins or not all(os.path.isfile(plugin) for plugin in plugins):
+		print('Please specify a path to a valid .ESM file.')
+		sys.exit(1)
+	elif SETTINGS['cells'] and SETTINGS['mmap'] and len(plugins) == 1 and not SETTINGS['dumpgroups'] and not SETTINGS['sqlite']:
+		# Only parse and write out the cells asked for. Dumps and
+		# databases hold everything, so they take a full parse.
+		with profileSection('phases', 'export', os.path.getsize(plugins[0])):
+			if not exportCellsIndexed(plugins[0], SETTINGS['cells']):
+				print('No cells match ' + ', '.join(SETTINGS['cells']) + '.')
+	elif SETTINGS['stream'] and len(plugins) == 1:
+		# Parse the base records of the .ESM, then parse
+		# and write out its cells one at a time
+		with profileSection('phases', 'stream', os.path.getsize(plugins[0])):
+			streamESM(plugins[0])
+	else:
+		if len(plugins) == 1:
+			# Parse the .ESM (or load the results of a previous
+			# parse) and populate our GRUPS dict with all of the
+			# information from relevant and parsable top groups
+			loadESM(plugins[0])
+		else:
+			# Otherwise parse the winning version of every record
+			# of the load order, as long as every master is found
+			with profileSection('phases', 'parse', sum(os.path.getsize(plugin) for plugin in plugins)):
+				if not loadPlugins(plugins):
+					sys.exit(1)
+
+		# Dump top group data to file
+		if SETTINGS['dumpgroups']:
+			with profileSection('phases', 'dump'):
+				writeObjectsToFile()
+
+		# Write everything parsed to an SQLite database
+		if SETTINGS['sqlite']:
+			with profileSection('phases', 'sqlite'):
+				writeObjectsToSQLite(SETTINGS['sqlite'])
+
+		# Generate cell manifests as .T3D files
+		if not SETTINGS['nomanifests']:	
+			with profileSection('phases', 'emit'):
+				generateCellManifests()
+
+		if RECORD_STORE is not None:
+			stats = RECORD_STORE.getStats()
+			print('Record cache: ' + str(stats['hits']) + ' hits, ' + str(stats['misses']) + ' misses, ' + str(stats['evictions']) + ' evictions, ' + str(stats['resident']) + ' records resident.')
+
+	if SETTINGS['profile']:
+		saveProfile(SETTINGS['profile'], [plugin for plugin in plugins if os.path.isfile(plugin)])
+
+# Workers of the process pool import this module too, so keep the
+# command line handling out of their way
+if __name__ == '__main__':
+	main()